@@ -1,40 +1,250 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
+import os
+import struct
 import sys
+import time
 import plistlib
+import persistent_worker
 
-if len(sys.argv) < 3:
-    print("Usage <merge|finalize> output_file [inputs]")
-    sys.exit(0)
+# Usage: acknowledgement_merger.py <--merge|--index|--finalize> output_file
+#                                  [inputs]
+#        acknowledgement_merger.py --persistent_worker
+#
+# Arguments may be passed in a param file, as @<path>. As a persistent worker,
+# it serves Bazel's JSON worker protocol.
+#
+# Inputs are acknowledgement plists, holding a fragment or a list of them, or
+# the output of --merge or --index. Fragments are deduplicated by Title, the
+# first one wins.
+#
+# License texts, the FooterText of fragments, are stored once, by the digest
+# of the text normalized for line endings and trailing whitespace. --finalize
+# emits each text once: titles sharing a text are joined into one group.
+#
+# --index writes an index instead of copying fragments: the magic, then a line
+# of kind, SHA-256 digest and path, separated by tabs, for each input. The
+# kind is "index" for an index and "fragment" otherwise. The finalize step
+# walks the indexes depth first, visiting each file once, so every fragment
+# is only read at the end, instead of being copied by every ancestor.
+#
+# --merge writes a records file: the magic, then records of a header of a kind
+# byte and the little endian uint32 lengths of a UTF-8 key and a body, then
+# the key and the body. A "T" record is a license text, keyed by its digest.
+# An "F" record is a fragment without its FooterText, keyed by title, NUL,
+# text digest, with the rest of the fragment as compact UTF-8 JSON. A text
+# precedes the fragments that reference it. Merging copies records it keeps
+# and skips the rest by their title, without parsing them. Only --finalize
+# parses fragments, and writes the XML plist for the Settings bundle.
+#
+# JSON rather than a binary plist, which stores non-ASCII license text as
+# UTF-16.
+#
+# Setting ACKNOWLEDGEMENT_MERGER_METRICS to a path appends a JSON line of
+# sizes and times for every --finalize, e.g. build with
+# --action_env=ACKNOWLEDGEMENT_MERGER_METRICS=/tmp/acknowledgements.jsonl
 
-output = sys.argv[2]
-action = sys.argv[1]
+k_records_magic = b"ackrec2\n"
+k_record_header = struct.Struct("<cII")
+k_index_magic = b"ackidx1\n"
 
-merged_fragments = []
-seen_licenses = set()
-for idx, arg in enumerate(sys.argv):
-    if idx <= 2:
-        continue
-    with open(arg, 'rb') as f:
-        input_plist = plistlib.load(f, fmt=plistlib.FMT_XML)
-        if not input_plist:
+def text_digest(text):
+    """ The digest of a license text, ignoring line endings and trailing
+    whitespace """
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    normalized = "\n".join(line.rstrip() for line in lines).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def write_index(output, paths):
+    with open(output, 'wb') as f:
+        f.write(k_index_magic)
+        for path in paths:
+            with open(path, 'rb') as input_f:
+                data = input_f.read()
+            kind = "index" if data.startswith(k_index_magic) else "fragment"
+            digest = hashlib.sha256(data).hexdigest()
+            f.write(("%s\t%s\t%s\n" % (kind, digest, path)).encode("utf-8"))
+
+def resolve_inputs(paths):
+    """ Yields the paths of fragment inputs, in order, expanding indexes
+
+    A file referenced more than once, by digest, is only visited the first
+    time. By then every fragment it leads to has been seen.
+    """
+    visited = set()
+    stack = [(path, path) for path in reversed(paths)]
+    while stack:
+        key, path = stack.pop()
+        if key in visited:
             continue
-        fragments = input_plist if isinstance(input_plist, list) else [input_plist]
-        for fragment in fragments:
-            # We only want to insert a given software license 1 time
-            title = fragment.get("Title")
+        visited.add(key)
+        with open(path, 'rb') as f:
+            if f.read(len(k_index_magic)) != k_index_magic:
+                yield path
+                continue
+            entries = [line.split("\t", 2) for line in
+                       f.read().decode("utf-8").splitlines()]
+        for kind, digest, entry_path in reversed(entries):
+            stack.append((digest, entry_path))
+
+def parse_plist(path):
+    """ Returns (title, text digest, fragment, UTF-8 text) for every fragment
+    of a plist input """
+    with open(path, 'rb') as f:
+        input_plist = plistlib.load(f, fmt=plistlib.FMT_XML)
+    if not input_plist:
+        return []
+    fragments = input_plist if isinstance(input_plist, list) else [input_plist]
+    parsed = []
+    for fragment in fragments:
+        fragment = dict(fragment)
+        text = fragment.pop("FooterText", None)
+        digest = ""
+        if text is not None:
+            digest = text_digest(text)
+            text = text.encode("utf-8")
+        parsed.append((fragment.get("Title") or "", digest, fragment, text))
+    return parsed
+
+# Parsed plist inputs, cached when running as a worker
+PARSED_PLISTS = persistent_worker.InputCache(parse_plist)
+
+def unique_fragments(paths, texts):
+    """ Yields (title, text digest, fragment) for the first fragment with each
+    title
+
+    The fragment, without its FooterText, is a dict from a plist input, or the
+    JSON bytes of a record. The UTF-8 license texts are added to texts, by
+    digest; the digest is empty for a fragment without a FooterText.
+    """
+    seen_licenses = set()
+    for path in resolve_inputs(paths):
+        with open(path, 'rb') as f:
+            if f.read(len(k_records_magic)) == k_records_magic:
+                while True:
+                    header = f.read(k_record_header.size)
+                    if not header:
+                        break
+                    kind, key_len, body_len = k_record_header.unpack(header)
+                    key = f.read(key_len).decode("utf-8")
+                    if kind == b"T":
+                        if key in texts:
+                            f.seek(body_len, 1)
+                        else:
+                            texts[key] = f.read(body_len)
+                        continue
+                    title, digest = key.split("\0")
+                    # We only want to insert a given software license 1 time
+                    if title in seen_licenses:
+                        f.seek(body_len, 1)
+                        continue
+                    seen_licenses.add(title)
+                    yield title, digest, f.read(body_len)
+                continue
+
+        for title, digest, fragment, text in PARSED_PLISTS.get(path):
             if title in seen_licenses:
                 continue
             seen_licenses.add(title)
+            if digest:
+                texts.setdefault(digest, text)
+            # Parsed fragments may be cached, so hand out copies
+            yield title, digest, dict(fragment)
+
+def write_records(output, fragments, texts):
+    written_texts = set()
+    with open(output, 'wb') as f:
+        def write_record(kind, key, body):
+            key = key.encode("utf-8")
+            f.write(k_record_header.pack(kind, len(key), len(body)))
+            f.write(key)
+            f.write(body)
+
+        f.write(k_records_magic)
+        for title, digest, fragment in fragments:
+            if digest and digest not in written_texts:
+                written_texts.add(digest)
+                write_record(b"T", digest, texts[digest])
+            if not isinstance(fragment, bytes):
+                fragment = json.dumps(fragment, ensure_ascii=False,
+                                      separators=(",", ":")).encode("utf-8")
+            write_record(b"F", title + "\0" + digest, fragment)
+
+def write_plist(output, fragments, texts):
+    """ Writes the Settings bundle plist, and returns metrics of it """
+    merged_fragments = []
+    groups = {}
+    num_fragments = 0
+    text_bytes = 0
+    for title, digest, fragment in fragments:
+        if isinstance(fragment, bytes):
+            fragment = json.loads(fragment.decode("utf-8"))
+        num_fragments += 1
+        if not digest:
             merged_fragments.append(fragment)
+            continue
+        text_bytes += len(texts[digest])
+
+        # Titles sharing a license text are listed in the group of the first
+        group = groups.get(digest)
+        if group is not None:
+            group["Title"] = "%s, %s" % (group.get("Title") or "",
+                                         fragment.get("Title") or "")
+            continue
+        fragment["FooterText"] = texts[digest].decode("utf-8")
+        groups[digest] = fragment
+        merged_fragments.append(fragment)
 
-if action == "--finalize":
     out_plist = {
         "StringsTable": "Acknowledgements",
         "PreferenceSpecifiers": merged_fragments
     }
     with open(output, 'wb') as f:
         plistlib.dump(out_plist, f, fmt=plistlib.FMT_XML)
-elif action == "--merge":
-    with open(output, 'wb') as f:
-        plistlib.dump(merged_fragments, f, fmt=plistlib.FMT_XML)
+
+    return {
+        "fragments": num_fragments,
+        "groups": len(merged_fragments),
+        "texts": len(groups),
+        "text_bytes": text_bytes,
+        "unique_text_bytes": sum(len(texts[digest]) for digest in groups),
+        "output_bytes": os.path.getsize(output),
+    }
+
+def run(args):
+    args = persistent_worker.expand_param_files(args)
+    if len(args) < 2:
+        print("Usage <merge|index|finalize> output_file [inputs]")
+        sys.exit(0)
+
+    start = time.time()
+    action = args[0]
+    output = args[1]
+    texts = {}
+    fragments = unique_fragments(args[2:], texts)
+    if action == "--finalize":
+        metrics = write_plist(output, fragments, texts)
+        metrics_path = os.environ.get("ACKNOWLEDGEMENT_MERGER_METRICS")
+        if metrics_path:
+            metrics["output"] = output
+            metrics["seconds"] = round(time.time() - start, 6)
+            with open(metrics_path, 'a') as f:
+                f.write(json.dumps(metrics, sort_keys=True) + "\n")
+    elif action == "--merge":
+        write_records(output, fragments, texts)
+    elif action == "--index":
+        write_index(output, args[2:])
+
+def main():
+    if "--persistent_worker" in sys.argv[1:]:
+        PARSED_PLISTS.max_entries = int(os.environ.get(
+            "ACKNOWLEDGEMENT_WORKER_CACHE_ENTRIES", 4096))
+        persistent_worker.run_worker(run, [PARSED_PLISTS], sys.stdin,
+                                     sys.stdout)
+    else:
+        run(sys.argv[1:])
+
+if __name__ == '__main__':
+    main()
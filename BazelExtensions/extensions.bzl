@@ -20,25 +20,54 @@ def _make_objc_interface_provider(header, module_map=None):
 
 def _acknowledgement_merger_impl(ctx):
     concat = ctx.attr.value.files.to_list() if ctx.attr.value else []
-    action = "--merge" if ctx.attr.value else "--finalize"
-    args = [action, ctx.outputs.out.path]
+    if not ctx.attr.value:
+        action = "--finalize"
+    elif ctx.attr.manifest:
+        action = "--index"
+    else:
+        action = "--merge"
+    args = ctx.actions.args()
+    args.add_all([action, ctx.outputs.out.path])
 
     # Merge all of the dep licenses
+    transitive_inputs = []
     for dep in ctx.attr.deps:
         license = dep.files.to_list()
         concat.extend(license)
+        if AcknowledgementProvider in dep and hasattr(
+                dep[AcknowledgementProvider], "transitive_inputs"):
+            transitive_inputs.append(
+                dep[AcknowledgementProvider].transitive_inputs)
+
+    args.add_all(concat)
 
-    for f in concat:
-        args.append(f.path)
+    # Arguments go through a param file, so that the action may run in a
+    # persistent acknowledgement_merger worker
+    args.use_param_file("@%s", use_always=True)
+    args.set_param_file_format("multiline")
+
+    # An index references the files it was built from, rather than copying
+    # them, so they are inputs of every action that reads it
+    inputs = depset(concat, transitive=transitive_inputs)
 
     # Write the final output. Bazel only writes the file when required
     ctx.actions.run(
-        inputs=concat,
-        arguments=args,
+        inputs=inputs,
+        arguments=[args],
         executable=ctx.attr.merger.files.to_list()[0],
-        outputs=[ctx.outputs.out]
+        outputs=[ctx.outputs.out],
+        mnemonic="AcknowledgementMerge",
+        execution_requirements={
+            "supports-workers": "1",
+            "requires-worker-protocol": "json",
+        },
     )
 
+    if action == "--index":
+        return [AcknowledgementProvider(
+            value=concat,
+            transitive_inputs=depset([ctx.outputs.out], transitive=[inputs]),
+        )]
     return [AcknowledgementProvider(value=concat)]
 
 
@@ -50,6 +79,9 @@ acknowledgement_merger = rule(
         "deps": attr.label_list(allow_files=True),
         "value": attr.label(),
         "output_name": attr.string(),
+        # Write an index of fragments instead of merging them, so that every
+        # fragment is only read by the finalize step
+        "manifest": attr.bool(default=False),
         "merger": attr.label(
             executable=True,
             cfg="host"
@@ -79,18 +111,21 @@ def acknowledgments_plist(name,
 # acknowledged target takes a value in the form of a license file
 #
 # It may depend on other acknowledged targets
+# manifest: write an index of the fragments rather than merging them
 
 
 def acknowledged_target(name,
                         deps,
                         value,
                         merger="//Vendor/rules_pods/BazelExtensions:acknowledgement_merger",
+                        manifest=False,
                         ):
     acknowledgement_merger(
         name=name,
         deps=deps,
         output_name=name + "-acknowledgement",
         value=value,
+        manifest=manifest,
         merger=merger,
         visibility=["//visibility:public"]
     )
@@ -159,6 +194,8 @@ def _get_module_map_headers(deps):
                 continue
             if input_file.path.endswith(".modulemap"):
                 continue
+            if input_file.path.endswith(".vfsoverlay.yaml"):
+                continue
             headers_list.append(input_file)
     return headers_list
 
@@ -333,6 +370,32 @@ def _make_headermap_json(namespace, hdrs):
     return struct(mappings=mappings).to_json()
 
 
+# Layers of a layered headermap and the manifest listing them
+HeadermapLayerInfo = provider(fields = ["manifest", "layers"])
+
+# The VFS overlay of a headermap, its virtual root, and the copts to compile
+# against it: -ivfsoverlay <overlay> -I<root>
+HeadermapVfsInfo = provider(fields = ["overlay", "root", "copts"])
+
+def _run_headermap_builder(ctx, inputs, arguments, outputs):
+    # Arguments go through a param file, so that the action may run in a
+    # persistent headermap_builder worker
+    args = ctx.actions.args()
+    args.add_all(arguments)
+    args.use_param_file("@%s", use_always=True)
+    args.set_param_file_format("multiline")
+    ctx.actions.run(
+        inputs=inputs,
+        arguments=[args],
+        executable=ctx.attr.headermap_builder.files.to_list()[0],
+        outputs=outputs,
+        mnemonic="HeaderMap",
+        execution_requirements={
+            "supports-workers": "1",
+            "requires-worker-protocol": "json",
+        },
+    )
+
 def _make_headermap_impl(ctx):
     # Write a JSON file for *this* headermap
     json_f = ctx.actions.declare_file(ctx.label.name + "_internal.json")
@@ -343,11 +406,18 @@ def _make_headermap_impl(ctx):
     )
 
     # Add a list of headermaps in JSON or hmap format
-    args = [ctx.outputs.headermap.path, json_f.path]
-    inputs = [json_f]
+    dep_hmaps = []
+    dep_manifests = []
+    dep_layers = []
 
     # Extract propagated headermaps
     for hdr_provider in ctx.attr.deps:
+        if ctx.attr.layered and HeadermapLayerInfo in hdr_provider:
+            layer_info = hdr_provider[HeadermapLayerInfo]
+            dep_manifests.append(layer_info.manifest)
+            dep_layers.append(layer_info.layers)
+            continue
+
         hdrs = []
 
         if CcInfo in hdr_provider:
@@ -362,30 +432,80 @@ def _make_headermap_impl(ctx):
         for hdr in hdrs:
             if hdr.path.endswith(".hmap"):
                 # Add headermaps
-                inputs.append(hdr)
-                args.append(hdr.path)
+                dep_hmaps.append(hdr)
 
-    ctx.actions.run(
-        inputs=inputs,
-        arguments=args,
-        executable=ctx.attr.headermap_builder.files.to_list()[0],
-        outputs=[ctx.outputs.headermap]
-    )
+    providers = []
+    if ctx.attr.layered:
+        # Each target writes a layer of its own mappings, and a manifest of
+        # the transitive layers. The headermap is then merged from the layers
+        # in one pass, rather than from the merged headermaps of its deps.
+        layer = ctx.actions.declare_file(ctx.label.name + ".hmaplayer")
+        manifest = ctx.actions.declare_file(ctx.label.name + ".hmapmanifest")
+        _run_headermap_builder(
+            ctx,
+            inputs=[json_f] + dep_manifests + dep_hmaps,
+            arguments=["--layer", layer.path, manifest.path, json_f.path] +
+                      [f.path for f in dep_manifests + dep_hmaps],
+            outputs=[layer, manifest]
+        )
+        layers = depset([layer] + dep_hmaps, transitive=dep_layers)
+        _run_headermap_builder(
+            ctx,
+            inputs=depset([manifest], transitive=[layers]),
+            arguments=["--merge", ctx.outputs.headermap.path, manifest.path],
+            outputs=[ctx.outputs.headermap]
+        )
+        providers.append(HeadermapLayerInfo(manifest=manifest, layers=layers))
+    else:
+        _run_headermap_builder(
+            ctx,
+            inputs=[json_f] + dep_hmaps,
+            arguments=[ctx.outputs.headermap.path, json_f.path] +
+                      [f.path for f in dep_hmaps],
+            outputs=[ctx.outputs.headermap]
+        )
+
+    outputs = [ctx.outputs.headermap]
+    if ctx.attr.vfs_overlay:
+        # The same mappings as a VFS overlay. clang only accepts an absolute
+        # root, and the execution root isn't known here, so the root is a
+        # virtual directory, unique to the label. The headers it lists are
+        # relative to the execution root, where clang runs.
+        overlay = ctx.actions.declare_file(ctx.label.name + ".vfsoverlay.yaml")
+        root = "/__headermap_vfs__/" + "/".join([
+            part
+            for part in [ctx.label.workspace_name, ctx.label.package,
+                         ctx.label.name]
+            if part
+        ])
+        _run_headermap_builder(
+            ctx,
+            inputs=[ctx.outputs.headermap],
+            arguments=["--vfs", overlay.path, root,
+                       ctx.outputs.headermap.path],
+            outputs=[overlay]
+        )
+        outputs.append(overlay)
+        providers.append(HeadermapVfsInfo(
+            overlay=overlay,
+            root=root,
+            copts=["-ivfsoverlay", overlay.path, "-I" + root],
+        ))
 
     compilation_context = cc_common.create_compilation_context(
-        headers=depset([ctx.outputs.headermap]))
+        headers=depset(outputs))
     objc_provider = _make_objc_interface_provider(
-        header=depset([ctx.outputs.headermap]),
+        header=depset(outputs),
     )
 
     return struct(
-        files=depset([ctx.outputs.headermap]),
-        providers=[
+        files=depset(outputs),
+        providers=providers + [
             CcInfo(compilation_context=compilation_context),
             objc_provider,
         ],
         objc=objc_provider,
-        headers=depset([ctx.outputs.headermap]),
+        headers=depset(outputs),
     )
 
 def headermap(
@@ -403,6 +523,15 @@ def headermap(
 # - Include the headermap
 # TODO(Add the ability to disallow propagation of "internal" includes )
 # e.g. "MyLib.h" instead of <MyLib/MyLib.h>
+# layered: merge the headermap from per target layers of headermap deps,
+# instead of from their merged headermaps. Each target still writes its full
+# headermap, but reads every transitive mapping once. See headermap_builder.py
+# vfs_overlay: also write the mappings as a clang VFS overlay,
+# <name>.vfsoverlay.yaml, an alternative to including the headermap. Rules
+# compiling against it add the copts of its HeadermapVfsInfo, and depend on
+# the target for the overlay. In copts of an objc_library, the same flags are
+# -ivfsoverlay $(GENDIR)/<package path>/<name>.vfsoverlay.yaml
+# -I/__headermap_vfs__/<workspace>/<package>/<name>
 _headermap = rule(
     implementation=_make_headermap_impl,
     output_to_genfiles=True,
@@ -410,6 +539,8 @@ _headermap = rule(
         "namespace": attr.string(mandatory=True),
         "hdrs": attr.label_list(mandatory=True),
         "deps": attr.label_list(mandatory=False),
+        "layered": attr.bool(default=False),
+        "vfs_overlay": attr.bool(default=False),
         "headermap_builder": attr.label(
             executable=True,
             cfg="host",
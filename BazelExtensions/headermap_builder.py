@@ -1,39 +1,257 @@
 #!/usr/bin/env python3
 from __future__ import print_function
 
+import hashlib
+import heapq
+import itertools
 import json
-import optparse
 import os
-import struct
+import shutil
 import sys
-import headermap_tool
 import tempfile
+import headermap_tool
+import persistent_worker
 
 # The data structure that LLVM uses is { mappings: { name: path } }
+#
+# Usage:
+#   headermap_builder.py <out.hmap> <mappings.json> [dep.hmap...]
+#     Write a headermap of the mappings merged with all dependency headermaps.
+#
+#   headermap_builder.py --layer <out.hmaplayer> <out.hmapmanifest>
+#                        <mappings.json> [dep.hmapmanifest|dep.hmap...]
+#     Write a layered headermap: a layer of just these mappings, sorted by
+#     key, and a manifest which lists the layers of all transitive deps.
+#     Every target still writes its full headermap, with --merge, so this
+#     doesn't write fewer bytes. It reads fewer: each transitive mapping is
+#     read once, rather than from the merged headermap of every dep.
+#
+#   headermap_builder.py --merge <out.hmap> <in.hmapmanifest>
+#     Write the headermap for a manifest, with a single k-way merge of the
+#     layers it lists.
+#
+#   headermap_builder.py --vfs <out.yaml> <build path> [in.hmap...]
+#     Write a clang VFS overlay of the merged headermaps, rooted at the build
+#     path, for use with -ivfsoverlay <out.yaml> -I<build path>. The build
+#     path must be absolute, and may be a directory that doesn't exist.
+#
+# Arguments may be passed in a param file, as @<path>.
+#
+#   headermap_builder.py --persistent_worker
+#     Run as a Bazel persistent worker, speaking the JSON worker protocol.
+#
+# HEADERMAP_LOAD_FACTOR sets the target fraction of buckets in use, 1/3 by
+# default. Lower is fewer probes per lookup, higher is smaller headermaps.
+#
+# Setting HEADERMAP_CACHE_DIR enables a cache of headermaps keyed by their
+# mappings, bounded to HEADERMAP_CACHE_MAX_BYTES (default 256MB). Under Bazel,
+# pass it with --action_env.
 
-def main():
-    """ Helper program for headermap rule"""
-    output_path = sys.argv[1]
-    json_path = sys.argv[2]
+# Bump when the headermap layout changes, to invalidate cached headermaps
+k_cache_version = "2"
+
+class HeadermapCache(object):
+    """ A directory of headermaps named by the digest of their mappings
+
+    On a hit, the cached headermap is hard linked, or copied, to the output
+    instead of encoding it again. Entries are evicted least recently used
+    first, by mtime, once the cache is over max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def digest(mappings, load_factor):
+        digest = hashlib.sha256(("%s %r\0" % (
+            k_cache_version, load_factor)).encode("utf-8"))
+        for key in sorted(mappings):
+            digest.update(key.encode("utf-8") + b"\0" +
+                          mappings[key].encode("utf-8") + b"\0")
+        return digest.hexdigest()
+
+    def _install(self, entry_path, output_path):
+        if os.path.lexists(output_path):
+            os.unlink(output_path)
+        try:
+            os.link(entry_path, output_path)
+        except OSError:
+            shutil.copyfile(entry_path, output_path)
+
+    def write(self, mappings, output_path, load_factor):
+        entry_path = os.path.join(self.cache_dir,
+                                  self.digest(mappings, load_factor) + ".hmap")
+        try:
+            os.utime(entry_path)
+            self._install(entry_path, output_path)
+            return
+        except OSError:
+            # A miss, or the entry was evicted concurrently
+            pass
+
+        headermap_tool.write_headermap(mappings, output_path, load_factor)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(output_path, tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, entry_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".hmap"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for mtime,size,path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+def write_headermap(mappings, output_path):
+    """ Writes a headermap through the cache, if it is enabled """
+    load_factor = float(os.environ.get("HEADERMAP_LOAD_FACTOR",
+                                       headermap_tool.k_default_load_factor))
+    cache_dir = os.environ.get("HEADERMAP_CACHE_DIR")
+    if not cache_dir:
+        headermap_tool.write_headermap(mappings, output_path, load_factor)
+        return
+    max_bytes = int(os.environ.get("HEADERMAP_CACHE_MAX_BYTES", 256 << 20))
+    if not isinstance(mappings, dict):
+        mappings = dict(mappings)
+    HeadermapCache(cache_dir, max_bytes).write(mappings, output_path,
+                                               load_factor)
+
+def read_mappings(path):
+    return list(headermap_tool.HeaderMap.frompath(path).mappings)
+
+# Mappings of dependency headermaps, cached when running as a worker
+MAPPINGS_CACHE = persistent_worker.InputCache(read_mappings)
 
-    if len(sys.argv) == 3:
-        headermap_tool.action_write("write", [json_path, output_path])
+def build_headermap(output_path, json_path, dep_paths):
+    with open(json_path, "r") as f:
+        input_data = json.load(f)
+
+    # Mappings from every additional headermap are merged in, in order, and
+    # override the mappings of this target.
+    dep_mappings = (MAPPINGS_CACHE.get(path) for path in dep_paths)
+    write_headermap(
+        itertools.chain(input_data["mappings"].items(), *dep_mappings),
+        output_path)
+
+def write_layer(output_path, mappings):
+    """ Writes mappings as NUL separated key, path pairs, sorted by key """
+    with open(output_path, "wb") as f:
+        for key in sorted(mappings):
+            f.write(key.encode("utf-8") + b"\0" +
+                    mappings[key].encode("utf-8") + b"\0")
+
+def read_layer(path):
+    """ Yields the (key, path) pairs of a layer, sorted by key
+
+    A full .hmap may stand in for the layer of a dep that isn't layered.
+    """
+    if path.endswith(".hmap"):
+        for mapping in sorted(MAPPINGS_CACHE.get(path)):
+            yield mapping
         return
+    with open(path, "rb") as f:
+        fields = f.read().split(b"\0")
+    for i in range(0, len(fields) - 1, 2):
+        yield (fields[i].decode("utf-8"), fields[i + 1].decode("utf-8"))
 
-    # We write an intermediate JSON file, which represents the trans hmap
-    fd, merge_file = tempfile.mkstemp()
+def read_manifest(path):
+    with open(path, "r") as f:
+        return f.read().splitlines()
+
+def build_layer(layer_path, manifest_path, json_path, dep_paths):
     with open(json_path, "r") as f:
         input_data = json.load(f)
-        # For every additional headermap, read it in and merge
-        for path in sys.argv[3:]:
-            add_hmap = headermap_tool.HeaderMap.frompath(path)
-            for mapping in add_hmap.mappings:
-                input_data["mappings"][mapping[0]] = mapping[1]
+    write_layer(layer_path, input_data["mappings"])
+
+    # The merged headermap is the mappings of this target, overridden by each
+    # dep's merged headermap in order. Flattened, a mapping from a later
+    # layer wins, so only the last occurrence of a shared layer matters.
+    layers = [layer_path]
+    for dep_path in dep_paths:
+        if dep_path.endswith(".hmap"):
+            layers.append(dep_path)
+        else:
+            layers.extend(read_manifest(dep_path))
+    seen = set()
+    deduped = []
+    for layer in reversed(layers):
+        if layer not in seen:
+            seen.add(layer)
+            deduped.append(layer)
+    deduped.reverse()
 
-        with open(merge_file, "w") as f:
-            json.dump(input_data, f, indent=2)
+    with open(manifest_path, "w") as f:
+        f.write("\n".join(deduped) + "\n")
 
-        headermap_tool.action_write("write", [merge_file, output_path])
+def merge_layers(layer_paths):
+    """ Yields the merged (key, path) pairs of layers, in key order
+
+    When layers share a key, the path of the last layer wins.
+    """
+    def tagged(idx, path):
+        for key,value in read_layer(path):
+            yield (key, idx, value)
+
+    merged = heapq.merge(*[tagged(idx, path)
+                           for idx,path in enumerate(layer_paths)])
+    pending = None
+    for key,idx,value in merged:
+        if pending and pending[0] != key:
+            yield pending
+        pending = (key, value)
+    if pending:
+        yield pending
+
+def build_from_manifest(output_path, manifest_path):
+    write_headermap(merge_layers(read_manifest(manifest_path)), output_path)
+
+def build_vfs_overlay(output_path, build_path, hmap_paths):
+    if not os.path.isabs(build_path):
+        sys.exit("error: VFS overlay root must be absolute: " + build_path)
+    headermap_tool.write_vfs_overlay(
+        itertools.chain(*[MAPPINGS_CACHE.get(path) for path in hmap_paths]),
+        build_path, output_path)
+
+def run(args):
+    args = persistent_worker.expand_param_files(args)
+    if args[0] == "--layer":
+        build_layer(args[1], args[2], args[3], args[4:])
+    elif args[0] == "--merge":
+        build_from_manifest(args[1], args[2])
+    elif args[0] == "--vfs":
+        build_vfs_overlay(args[1], args[2], args[3:])
+    else:
+        build_headermap(args[0], args[1], args[2:])
+
+def main():
+    """ Helper program for headermap rule"""
+    if "--persistent_worker" in sys.argv[1:]:
+        MAPPINGS_CACHE.max_entries = int(os.environ.get(
+            "HEADERMAP_WORKER_CACHE_ENTRIES", 1024))
+        persistent_worker.run_worker(run, [MAPPINGS_CACHE], sys.stdin,
+                                     sys.stdout)
+    else:
+        run(sys.argv[1:])
 
 if __name__ == '__main__':
     main()
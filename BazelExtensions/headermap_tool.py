@@ -6,7 +6,11 @@
 
 from __future__ import print_function
 
+import array
+import itertools
 import json
+import math
+import mmap
 import optparse
 import os
 import struct
@@ -23,92 +27,153 @@ def hmap_hash(str):
     Apply the "well-known" headermap hash function.
     """
 
-    return sum((ord(c.lower()) * 13
-                for c in str), 0)
+    return hmap_hash_bytes(str.encode('utf-8'))
+
+# Bytes that clang sees as negative `char`s
+k_high_bytes = bytes(range(0x80, 0x100))
+
+def hmap_hash_bytes(key):
+    """hash(bytes) -> int
+
+    The headermap hash of a UTF-8 key. Like clang, this lowercases ASCII only
+    and sums signed chars; `char` is signed on Apple platforms. The result is
+    only meaningful masked to the number of buckets.
+    """
+
+    key = key.lower()
+    num_high = len(key) - len(key.translate(None, k_high_bytes))
+    return (sum(key) - 256 * num_high) * 13
+
+# An array typecode for uint32_t
+k_uint32_code = 'I' if array.array('I').itemsize == 4 else 'L'
 
 class HeaderMap(object):
+    """A read only view of a headermap.
+
+    Files are memory mapped; buckets and strings are decoded on demand, so
+    large transitive headermaps are never materialized.
+    """
+
     @staticmethod
     def frompath(path):
         with open(path, 'rb') as f:
-            magic = f.read(4)
-            if isinstance(magic, bytes):
-                magic = magic.decode("utf-8")
-            if magic == k_header_magic_LE:
-                endian_code = '<'
-            elif magic == k_header_magic_BE:
-                endian_code = '>'
-            else:
-                raise SystemExit("error: %s: not a headermap" % (
-                        path,))
-
-            # Read the header information.
-            header_fmt = endian_code + 'HHIIII'
-            header_size = struct.calcsize(header_fmt)
-            data = f.read(header_size)
-            if len(data) != header_size:
-                raise SystemExit("error: %s: truncated headermap header" % (
-                        path,))
-
-            (version, reserved, strtable_offset, num_entries,
-             num_buckets, max_value_len) = struct.unpack(header_fmt, data)
-
-            if version != 1:
-                raise SystemExit("error: %s: unknown headermap version: %r" % (
-                        path, version))
-            if reserved != 0:
-                raise SystemExit("error: %s: invalid reserved value in header" % (
-                        path,))
-
-            # The number of buckets must be a power of two.
-            if num_buckets == 0 or (num_buckets & num_buckets - 1) != 0:
-                raise SystemExit("error: %s: invalid number of buckets" % (
-                        path,))
-
-            # Read all of the buckets.
-            bucket_fmt = endian_code + 'III'
-            bucket_size = struct.calcsize(bucket_fmt)
-            buckets_data = f.read(num_buckets * bucket_size)
-            if len(buckets_data) != num_buckets * bucket_size:
-                raise SystemExit("error: %s: truncated headermap buckets" % (
-                        path,))
-            buckets = [struct.unpack(bucket_fmt,
-                                     buckets_data[i*bucket_size:(i+1)*bucket_size])
-                       for i in range(num_buckets)]
-
-            # Read the string table; the format doesn't explicitly communicate the
-            # size of the string table (which is dumb), so assume it is the rest of
-            # the file.
-            f.seek(0, 2)
-            strtable_size = f.tell() - strtable_offset
-            f.seek(strtable_offset)
-
-            if strtable_size == 0:
-                raise SystemExit("error: %s: unable to read zero-sized string table"%(
-                        path,))
-            strtable = f.read(strtable_size)
-            if isinstance(strtable, bytes):
-                strtable = strtable.decode("utf-8")
-
-            if len(strtable) != strtable_size:
-                raise SystemExit("error: %s: unable to read complete string table"%(
-                        path,))
-            if strtable[-1] != '\0':
-                raise SystemExit("error: %s: invalid string table in headermap" % (
-                        path,))
-
-            return HeaderMap(num_entries, buckets, strtable)
-
-    def __init__(self, num_entries, buckets, strtable):
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                data = b''
+        return HeaderMap.frombytes(data, path)
+
+    @staticmethod
+    def frombytes(data, path='<memory>'):
+        magic = bytes(data[0:4]).decode("utf-8", "replace")
+        if magic == k_header_magic_LE:
+            endian_code = '<'
+        elif magic == k_header_magic_BE:
+            endian_code = '>'
+        else:
+            raise SystemExit("error: %s: not a headermap" % (
+                    path,))
+
+        # Read the header information.
+        header_fmt = endian_code + 'HHIIII'
+        header_size = struct.calcsize(header_fmt)
+        if len(data) < 4 + header_size:
+            raise SystemExit("error: %s: truncated headermap header" % (
+                    path,))
+
+        (version, reserved, strtable_offset, num_entries,
+         num_buckets, max_value_len) = struct.unpack_from(header_fmt, data, 4)
+
+        if version != 1:
+            raise SystemExit("error: %s: unknown headermap version: %r" % (
+                    path, version))
+        if reserved != 0:
+            raise SystemExit("error: %s: invalid reserved value in header" % (
+                    path,))
+
+        # The number of buckets must be a power of two.
+        if num_buckets == 0 or (num_buckets & num_buckets - 1) != 0:
+            raise SystemExit("error: %s: invalid number of buckets" % (
+                    path,))
+
+        buckets_offset = 4 + header_size
+        bucket_fmt = endian_code + 'III'
+        if len(data) < buckets_offset + num_buckets * struct.calcsize(bucket_fmt):
+            raise SystemExit("error: %s: truncated headermap buckets" % (
+                    path,))
+
+        # The format doesn't explicitly communicate the size of the string
+        # table (which is dumb), so assume it is the rest of the file.
+        if strtable_offset >= len(data):
+            raise SystemExit("error: %s: unable to read zero-sized string table"%(
+                    path,))
+        if data[len(data) - 1] != 0:
+            raise SystemExit("error: %s: invalid string table in headermap" % (
+                    path,))
+
+        return HeaderMap(path, data, endian_code, buckets_offset,
+                         strtable_offset, num_entries, num_buckets,
+                         max_value_len)
+
+    def __init__(self, path, data, endian_code, buckets_offset,
+                 strtable_offset, num_entries, num_buckets, max_value_len):
+        self.path = path
+        self.data = data
+        self.bucket_fmt = endian_code + 'III'
+        self.bucket_size = struct.calcsize(self.bucket_fmt)
+        self.buckets_offset = buckets_offset
+        self.strtable_offset = strtable_offset
         self.num_entries = num_entries
-        self.buckets = buckets
-        self.strtable = strtable
+        self.num_buckets = num_buckets
+        self.max_value_len = max_value_len
 
-    def get_string(self, idx):
-        if idx >= len(self.strtable):
+    @property
+    def strtable_size(self):
+        return len(self.data) - self.strtable_offset
+
+    @property
+    def buckets(self):
+        """Iterates (key, prefix, suffix) string offsets of every bucket"""
+        buckets_end = self.buckets_offset + self.num_buckets * self.bucket_size
+        view = memoryview(self.data)[self.buckets_offset:buckets_end]
+        try:
+            for bucket in struct.iter_unpack(self.bucket_fmt, view):
+                yield bucket
+        finally:
+            view.release()
+
+    def get_bucket(self, idx):
+        return struct.unpack_from(self.bucket_fmt, self.data,
+                                  self.buckets_offset + idx * self.bucket_size)
+
+    def get_string_bytes(self, idx):
+        start = self.strtable_offset + idx
+        if idx >= self.strtable_size:
             raise SystemExit("error: %s: invalid string index" % (
-                    path,))
-        end_idx = self.strtable.index('\0', idx)
-        return self.strtable[idx:end_idx]
+                    self.path,))
+        return self.data[start:self.data.find(b'\0', start)]
+
+    def get_string(self, idx):
+        return self.get_string_bytes(idx).decode('utf-8')
+
+    def lookup(self, key):
+        """lookup(str) -> str or None
+
+        Find the path for key, probing the way clang does: from the hash of
+        the key until an empty bucket, comparing keys ASCII case insensitively.
+        """
+        key_bytes = key.encode('utf-8').lower()
+        mask = self.num_buckets - 1
+        idx = hmap_hash_bytes(key_bytes)
+        for i in range(self.num_buckets):
+            key_idx,prefix_idx,suffix_idx = self.get_bucket(idx & mask)
+            if key_idx == 0:
+                return None
+            if self.get_string_bytes(key_idx).lower() == key_bytes:
+                return self.get_string(prefix_idx) + self.get_string(suffix_idx)
+            idx += 1
+        return None
 
     @property
     def mappings(self):
@@ -142,8 +207,8 @@ def action_dump(name, args):
     if opts.verbose:
         print ('headermap: %r' % (path,))
         print ('  num entries: %d' % (hmap.num_entries,))
-        print ('  num buckets: %d' % (len(hmap.buckets),))
-        print ('  string table size: %d' % (len(hmap.strtable),))
+        print ('  num buckets: %d' % (hmap.num_buckets,))
+        print ('  string table size: %d' % (hmap.strtable_size,))
         for i,bucket in enumerate(hmap.buckets):
             key_idx,prefix_idx,suffix_idx = bucket
 
@@ -156,65 +221,275 @@ def action_dump(name, args):
             suffix = hmap.get_string(suffix_idx)
 
             print ("  bucket[%d]: %r -> (%r, %r) -- %d" % (
-                i, key, prefix, suffix, (hmap_hash(key) & (num_buckets - 1))))
+                i, key, prefix, suffix,
+                (hmap_hash(key) & (hmap.num_buckets - 1))))
     else:
         mappings = sorted(hmap.mappings)
         for key,value in mappings:
             print ("%s -> %s" % (key, value))
     print ()
 
-def next_power_of_two(value):
-    if value < 0:
-        raise ArgumentError
-    return 1 if value == 0 else 2**(value - 1).bit_length()
+def probe_lengths(hmap):
+    """probe_lengths(HeaderMap) -> (hits, misses)
 
-def action_write(name, args):
-    "write a headermap file from a JSON definition"
+    hits is the number of buckets clang probes to find each key. misses is,
+    for each bucket, the number probed by a lookup that starts there and
+    fails, ending at the first empty bucket.
+    """
+    mask = hmap.num_buckets - 1
+    occupied = []
+    hits = []
+    for i,(key_idx,prefix_idx,suffix_idx) in enumerate(hmap.buckets):
+        occupied.append(key_idx != 0)
+        if key_idx == 0:
+            continue
+        home = hmap_hash_bytes(hmap.get_string_bytes(key_idx)) & mask
+        hits.append(((i - home) & mask) + 1)
+
+    # Walk backwards from an empty bucket, so each run is counted once.
+    misses = [0] * hmap.num_buckets
+    if not all(occupied):
+        start = occupied.index(False)
+        run = 0
+        for i in range(start, start - hmap.num_buckets, -1):
+            run = run + 1 if occupied[i] else 0
+            misses[i] = run + 1
+    else:
+        misses = [hmap.num_buckets] * hmap.num_buckets
+    return hits, misses
 
-    parser = optparse.OptionParser("%%prog %s [options] <input path> <output path>" % (
+def action_stats(name, args):
+    "report how well a headermap file is packed"
+
+    parser = optparse.OptionParser("%%prog %s [options] <headermap path>" % (
+            name,))
+    (opts, args) = parser.parse_args(args)
+
+    if len(args) != 1:
+        parser.error("invalid number of arguments")
+
+    path, = args
+
+    hmap = HeaderMap.frompath(path)
+    hits, misses = probe_lengths(hmap)
+    num_used = len(hits)
+
+    # Every string the buckets reference, by offset. A string stored at more
+    # than one offset, or not referenced at all, is wasted.
+    strings = {}
+    num_refs = 0
+    ref_bytes = 0
+    for bucket in hmap.buckets:
+        if bucket[0] == 0:
+            continue
+        for idx in bucket:
+            if idx not in strings:
+                strings[idx] = len(hmap.get_string_bytes(idx)) + 1
+            num_refs += 1
+            ref_bytes += strings[idx]
+    live_bytes = sum(strings.values())
+    distinct_bytes = sum(len(string) + 1 for string in set(
+        hmap.get_string_bytes(idx) for idx in strings))
+    # The leading NUL of the table is required, not wasted.
+    unreferenced_bytes = hmap.strtable_size - 1 - live_bytes
+    empty_bytes = (hmap.num_buckets - num_used) * struct.calcsize(
+        hmap.bucket_fmt)
+
+    print ('headermap: %s' % (path,))
+    print ('  size: %d bytes' % (len(hmap.data),))
+    print ('  entries: %d' % (num_used,))
+    print ('  buckets: %d' % (hmap.num_buckets,))
+    print ('  load factor: %.3f' % (float(num_used) / hmap.num_buckets,))
+    if hits:
+        print ('  probes per hit: mean %.3f, max %d' % (
+            float(sum(hits)) / len(hits), max(hits)))
+    print ('  probes per miss: mean %.3f, max %d' % (
+        float(sum(misses)) / len(misses), max(misses)))
+    print ('  probe length histogram:')
+    histogram = {}
+    for length in hits:
+        histogram[length] = histogram.get(length, 0) + 1
+    for length in sorted(histogram):
+        print ('    %6d: %d' % (length, histogram[length]))
+    print ('  string table: %d bytes, %d references to %d strings' % (
+        hmap.strtable_size, num_refs, len(strings)))
+    if live_bytes:
+        print ('  string dedup ratio: %.2f' % (float(ref_bytes) / live_bytes,))
+    print ('  bytes wasted: %d' % (
+        empty_bytes + (live_bytes - distinct_bytes) + unreferenced_bytes,))
+    print ('    empty buckets: %d' % (empty_bytes,))
+    print ('    duplicate strings: %d' % (live_bytes - distinct_bytes,))
+    print ('    unreferenced strings: %d' % (unreferenced_bytes,))
+
+def sorted_buckets(hmap):
+    """Returns (key bytes, prefix idx, suffix idx) of every entry, by key"""
+    return sorted((hmap.get_string_bytes(key_idx), prefix_idx, suffix_idx)
+                  for key_idx,prefix_idx,suffix_idx in hmap.buckets
+                  if key_idx != 0)
+
+def action_diff(name, args):
+    "compare the mappings of two headermap files"
+
+    parser = optparse.OptionParser(
+        "%%prog %s [options] <old headermap path> <new headermap path>" % (
             name,))
     (opts, args) = parser.parse_args(args)
 
     if len(args) != 2:
         parser.error("invalid number of arguments")
 
-    input_path,output_path = args
+    old = HeaderMap.frompath(args[0])
+    new = HeaderMap.frompath(args[1])
+
+    def value(hmap, entry):
+        return hmap.get_string(entry[1]) + hmap.get_string(entry[2])
+
+    # Both maps are sorted by key and walked together, so every key is
+    # visited once and paths are only decoded for keys that are compared.
+    old_entries = sorted_buckets(old)
+    new_entries = sorted_buckets(new)
+    i = j = 0
+    num_changes = 0
+    while i < len(old_entries) or j < len(new_entries):
+        if j == len(new_entries) or (i < len(old_entries) and
+                                     old_entries[i][0] < new_entries[j][0]):
+            print ("- %s -> %s" % (old_entries[i][0].decode('utf-8'),
+                                   value(old, old_entries[i])))
+            i += 1
+            num_changes += 1
+        elif i == len(old_entries) or new_entries[j][0] < old_entries[i][0]:
+            print ("+ %s -> %s" % (new_entries[j][0].decode('utf-8'),
+                                   value(new, new_entries[j])))
+            j += 1
+            num_changes += 1
+        else:
+            old_value = value(old, old_entries[i])
+            new_value = value(new, new_entries[j])
+            if old_value != new_value:
+                print ("~ %s -> %s, was %s" % (
+                    new_entries[j][0].decode('utf-8'), new_value, old_value))
+                num_changes += 1
+            i += 1
+            j += 1
+
+    # Like diff(1), exit with 1 when the mappings differ.
+    if num_changes:
+        sys.exit(1)
+
+class StringTable(object):
+    """A headermap string table which stores every distinct string once.
+
+    Keys, prefixes and suffixes are interned, so the directory prefix shared
+    by many headers is written a single time and referenced by offset.
+    """
 
-    with open(input_path, "r") as f:
-        input_data = json.load(f)
+    def __init__(self):
+        # Offset 0 is never handed out; a key offset of 0 is an empty bucket.
+        self.data = bytearray(b'\0')
+        self.offsets = {}
+
+    def add(self, string):
+        offset = self.offsets.get(string)
+        if offset is None:
+            offset = len(self.data)
+            self.data += string.encode('utf-8')
+            self.data.append(0)
+            self.offsets[string] = offset
+        return offset
+
+def next_power_of_two(value):
+    if value < 0:
+        raise ArgumentError
+    return 1 if value == 0 else 2**(value - 1).bit_length()
+
+# The default fraction of buckets in use; tables are sized to at most this.
+k_default_load_factor = 1.0 / 3
+
+def layout_buckets(hashes, keys, num_buckets):
+    """layout_buckets(hashes, keys, num_buckets) -> positions
+
+    Place entries the way Robin Hood hashing would: in order of their home
+    bucket, each in the first free bucket at or after it. No entry is ever
+    displaced further than one with an earlier home, which keeps the longest
+    probe short, and every bucket between an entry's home and its position
+    is full, so clang's linear probe still finds it. Ties are broken by key,
+    so the layout doesn't depend on the order of the mappings.
+
+    Positions are not wrapped; the bucket is the position masked.
+    """
+    mask = num_buckets - 1
+    order = sorted(range(len(hashes)), key=lambda i: (hashes[i] & mask, keys[i]))
+    positions = [0] * len(hashes)
+
+    # A run of entries that overflows the end of the table wraps to its
+    # start, so lay out again with that many buckets reserved until the
+    # overflow fits.
+    reserved = 0
+    while True:
+        cursor = reserved
+        for i in order:
+            pos = max(hashes[i] & mask, cursor)
+            positions[i] = pos
+            cursor = pos + 1
+        overflow = max(cursor - num_buckets, 0)
+        if overflow <= reserved:
+            return positions
+        reserved = overflow
+
+def write_headermap(mappings, output_path, load_factor=k_default_load_factor):
+    """Write a headermap file.
+
+    mappings is a dict of key to path, or an iterable of (key, path) pairs in
+    which later pairs replace earlier ones. Pairs are consumed as they are
+    produced, so they can be streamed from other headermaps.
+
+    The table is sized to at most load_factor full. Returns the maximum and
+    mean number of buckets clang probes to find a key.
+    """
 
-    # Compute the headermap contents, we make a table that is 1/3 full.
-    mappings = input_data['mappings']
-    num_buckets = next_power_of_two(len(mappings) * 3)
+    if not 0 < load_factor < 1:
+        raise ValueError("invalid load factor: %r" % (load_factor,))
+    if not isinstance(mappings, dict):
+        mappings = dict(mappings)
+
+    # Keep at least one bucket empty, so failed lookups terminate.
+    num_buckets = next_power_of_two(max(
+        int(math.ceil(len(mappings) / load_factor)), len(mappings) + 1))
 
-    table = [(0, 0, 0)
-             for i in range(num_buckets)]
     max_value_len = 0
-    strtable = "\0"
-    for key,value in mappings.items():
+    strtable = StringTable()
+    entries = []
+    keys = []
+    hashes = []
+    # Strings are interned in key order, so the whole file, not just the
+    # layout, doesn't depend on the order of the mappings.
+    for key,value in sorted(mappings.items()):
         if not isinstance(key, str):
             key = key.decode('utf-8')
         if not isinstance(value, str):
             value = value.decode('utf-8')
         max_value_len = max(max_value_len, len(value))
 
-        key_idx = len(strtable)
-        strtable += key + '\0'
-        prefix = os.path.dirname(value) + '/'
-        suffix = os.path.basename(value)
-        prefix_idx = len(strtable)
-        strtable += prefix + '\0'
-        suffix_idx = len(strtable)
-        strtable += suffix + '\0'
-
-        hash = hmap_hash(key)
-        for i in range(num_buckets):
-            idx = (hash + i) % num_buckets
-            if table[idx][0] == 0:
-                table[idx] = (key_idx, prefix_idx, suffix_idx)
-                break
-        else:
-            raise RuntimeError
+        entries.append((strtable.add(key),
+                        strtable.add(os.path.dirname(value) + '/'),
+                        strtable.add(os.path.basename(value))))
+        key_bytes = key.encode('utf-8')
+        keys.append(key_bytes)
+        hashes.append(hmap_hash_bytes(key_bytes))
+
+    # Buckets are (key, prefix, suffix) string offsets, packed in place.
+    positions = layout_buckets(hashes, keys, num_buckets)
+    mask = num_buckets - 1
+    table = array.array(k_uint32_code, bytes(num_buckets * 3 * 4))
+    probes = []
+    for entry,hash,pos in zip(entries, hashes, positions):
+        probes.append(pos - (hash & mask) + 1)
+        idx = (pos & mask) * 3
+        table[idx] = entry[0]
+        table[idx + 1] = entry[1]
+        table[idx + 2] = entry[2]
+    if sys.byteorder == 'big':
+        table.byteswap()
 
     endian_code = '<'
     magic = k_header_magic_LE
@@ -231,54 +506,138 @@ def action_write(name, args):
     with open(output_path, 'wb') as f:
         f.write(magic.encode())
         f.write(struct.pack(header_fmt, *header))
-        for bucket in table:
-            f.write(struct.pack(bucket_fmt, *bucket))
-        f.write(strtable.encode())
+        f.write(table.tobytes())
+        f.write(strtable.data)
 
-def action_tovfs(name, args):
-    "convert a headermap to a VFS layout"
+    if not probes:
+        return (0, 0.0)
+    return (max(probes), float(sum(probes)) / len(probes))
 
-    parser = optparse.OptionParser("%%prog %s [options] <headermap path>" % (
+def action_write(name, args):
+    "write a headermap file from a JSON definition"
+
+    parser = optparse.OptionParser("%%prog %s [options] <input path> <output path>" % (
             name,))
-    parser.add_option("", "--build-path", dest="build_path",
-                      help="build path prefix",
-                      action="store", type=str)
+    parser.add_option("", "--load-factor", dest="load_factor",
+                      help="target fraction of buckets in use [%default]",
+                      action="store", type=float,
+                      default=k_default_load_factor)
+    parser.add_option("-v", "--verbose", dest="verbose",
+                      help="report probe lengths [%default]",
+                      action="store_true", default=False)
     (opts, args) = parser.parse_args(args)
 
     if len(args) != 2:
         parser.error("invalid number of arguments")
-    if opts.build_path is None:
-        parser.error("--build-path is required")
+    if not 0 < opts.load_factor < 1:
+        parser.error("--load-factor must be between 0 and 1")
 
     input_path,output_path = args
 
-    hmap = HeaderMap.frompath(input_path)
-
-    # Create the table for all the objects.
-    vfs = {}
-    vfs['version'] = 0
-    build_dir_contents = []
-    vfs['roots'] = [{
-            'name' : opts.build_path,
-            'type' : 'directory',
-            'contents' : build_dir_contents }]
-
-    # We assume we are mapping framework paths, so a key of "Foo/Bar.h" maps to
-    # "<build path>/Foo.framework/Headers/Bar.h".
-    for key,value in hmap.mappings:
-        # If this isn't a framework style mapping, ignore it.
-        components = key.split('/')
-        if len(components) != 2:
+    with open(input_path, "r") as f:
+        input_data = json.load(f)
+
+    max_probes, mean_probes = write_headermap(
+        input_data['mappings'], output_path, opts.load_factor)
+    if opts.verbose:
+        print ('probes per hit: mean %.3f, max %d' % (mean_probes, max_probes))
+
+def vfs_tree(mappings, layout):
+    """vfs_tree(mappings, layout) -> dict
+
+    Group mappings into a tree of directory name to subtree, with paths at
+    the leaves. In the "include" layout a key of "Foo/Bar.h" is at
+    "Foo/Bar.h", for use with -I. In the "framework" layout it is at
+    "Foo.framework/Headers/Bar.h", for use with -F; keys without a
+    framework component are left out.
+
+    Like headermap lookups, and the overlay, names are matched ignoring
+    case, so each level maps a lower cased name to (name, subtree or path).
+    A directory keeps the first spelling of its name.
+    """
+
+    root = {}
+    for key,value in mappings:
+        components = [c for c in key.split('/') if c]
+        if layout == 'framework':
+            if len(components) < 2:
+                continue
+            components[0:1] = [components[0] + '.framework', 'Headers']
+        if not components:
             continue
-        framework_name,header_name = components
-        build_dir_contents.append({
-                'name' : '%s.framework/Headers/%s' % (framework_name,
-                                                      header_name),
-                'type' : 'file',
-                'external-contents' : value })
+        parent = root
+        for component in components[:-1]:
+            entry = parent.get(component.lower())
+            if entry is None or not isinstance(entry[1], dict):
+                # A directory replaces a file of the same name.
+                entry = parent[component.lower()] = (component, {})
+            parent = entry[1]
+        entry = parent.get(components[-1].lower())
+        if entry is None or not isinstance(entry[1], dict):
+            parent[components[-1].lower()] = (components[-1], value)
+    return root
+
+def write_vfs_overlay(mappings, build_path, output_path, layout='include'):
+    """Write a clang VFS overlay of mappings, rooted at build_path.
+
+    mappings is an iterable of (key, path) pairs in which later pairs replace
+    earlier ones. Entries are nested by directory, rather than a flat list of
+    full names, and the JSON is written compactly as the tree is walked.
+    clang requires build_path to be absolute; it needn't exist.
+    """
+
+    tree = vfs_tree(mappings, layout)
+    dumps = json.dumps
 
     with open(output_path, 'w') as f:
-        json.dump(vfs, f, indent=2)
+        def write_contents(node):
+            f.write('[')
+            for i,folded in enumerate(sorted(node)):
+                if i:
+                    f.write(',')
+                name, child = node[folded]
+                if isinstance(child, dict):
+                    f.write('{"name":%s,"type":"directory","contents":' % (
+                        dumps(name),))
+                    write_contents(child)
+                    f.write('}')
+                else:
+                    f.write('{"name":%s,"type":"file","external-contents":%s}'
+                            % (dumps(name), dumps(child)))
+            f.write(']')
+
+        # Headermap lookups are case insensitive, and so is the overlay.
+        f.write('{"version":0,"case-sensitive":"false","roots":[')
+        f.write('{"name":%s,"type":"directory","contents":' % (
+            dumps(build_path),))
+        write_contents(tree)
+        f.write('}]}\n')
+
+def action_tovfs(name, args):
+    "convert headermaps to a VFS layout"
+
+    parser = optparse.OptionParser(
+        "%%prog %s [options] <headermap path>... <output path>" % (name,))
+    parser.add_option("", "--build-path", dest="build_path",
+                      help="build path prefix",
+                      action="store", type=str)
+    parser.add_option("", "--layout", dest="layout",
+                      help="framework or include [%default]",
+                      action="store", type="choice",
+                      choices=["framework", "include"], default="framework")
+    (opts, args) = parser.parse_args(args)
+
+    if len(args) < 2:
+        parser.error("invalid number of arguments")
+    if opts.build_path is None:
+        parser.error("--build-path is required")
+
+    input_paths,output_path = args[:-1],args[-1]
+
+    # Mappings of later headermaps override earlier ones.
+    hmaps = [HeaderMap.frompath(path) for path in input_paths]
+    write_vfs_overlay(itertools.chain(*[hmap.mappings for hmap in hmaps]),
+                      opts.build_path, output_path, opts.layout)
 
 commands = dict((name[7:].replace("_","-"), f)
                 for name,f in locals().items()
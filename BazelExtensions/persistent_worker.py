@@ -0,0 +1,93 @@
+import collections
+import io
+import json
+import sys
+import traceback
+
+# Support for the helper programs that Bazel may run as persistent workers,
+# headermap_builder.py and acknowledgement_merger.py.
+#
+# Bazel passes the arguments of an action in a param file, as @<path>, with
+# one argument per line. As a worker, a program reads a WorkRequest of the
+# JSON worker protocol per line from stdin, and writes a WorkResponse per
+# line to stdout:
+#   { "arguments": [...], "inputs": [{ "path", "digest" }...], "requestId" }
+#   { "exitCode", "output", "requestId" }
+
+def expand_param_files(args):
+    expanded = []
+    for arg in args:
+        if arg.startswith("@"):
+            with open(arg[1:], "r") as f:
+                expanded.extend(f.read().splitlines())
+        else:
+            expanded.append(arg)
+    return expanded
+
+class InputCache(object):
+    """ An LRU of values loaded from the inputs of actions
+
+    A persistent worker sees the same inputs over and over. Entries are keyed
+    by path and the digest Bazel reports for the input, so a changed input is
+    never served stale. Without a digest, inputs are loaded every time.
+    """
+
+    def __init__(self, load, max_entries=0):
+        self.load = load
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.digests = {}
+
+    def get(self, path):
+        digest = self.digests.get(path)
+        if not digest:
+            return self.load(path)
+        key = (path, digest)
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            return value
+        value = self.load(path)
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+def run_worker(run, caches, stdin, stdout):
+    """ Serves WorkRequests by calling run with their arguments, until stdin
+    is closed
+
+    The caches, InputCaches, are given the digests of each request's inputs.
+    """
+    for line in stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        digests = dict(
+            (i["path"], i.get("digest")) for i in request.get("inputs", []))
+        for cache in caches:
+            cache.digests = digests
+        output = io.StringIO()
+        exit_code = 0
+        saved_stdout = sys.stdout
+        sys.stdout = output
+        try:
+            run(request.get("arguments", []))
+        except SystemExit as error:
+            # Usage errors and invalid inputs are reported as SystemExit
+            if error.code not in (None, 0):
+                exit_code = 1
+                output.write(str(error.code) + "\n")
+        except Exception:
+            exit_code = 1
+            output.write(traceback.format_exc())
+        finally:
+            sys.stdout = saved_stdout
+
+        response = {
+            "exitCode": exit_code,
+            "output": output.getvalue(),
+            "requestId": request.get("requestId", 0),
+        }
+        stdout.write(json.dumps(response) + "\n")
+        stdout.flush()
@@ -6,14 +6,44 @@ import sys
 # PackageName_Bundle_BundleName
 # Move them to BundleName.bundle
 bundle_token = "_Bundle_"
+
+def bundle_renames(root):
+    """ Returns (path, new path) for every bundle directory under root
+
+    The tree is scanned once, bottom up, so bundles nested in a bundle come
+    before it and are renamed while its path is still valid.
+    """
+    renames = []
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        for dirname in dirnames:
+            if bundle_token not in dirname:
+                continue
+            bundle_name = dirname.split(bundle_token, 1)[1]
+            if not bundle_name:
+                continue
+            renames.append((os.path.join(dirpath, dirname),
+                            os.path.join(dirpath, bundle_name)))
+
+    root = os.path.normpath(root)
+    root_name = os.path.basename(root)
+    if bundle_token in root_name and root_name.split(bundle_token, 1)[1]:
+        renames.append((root, os.path.join(os.path.dirname(root),
+                                           root_name.split(bundle_token, 1)[1])))
+    return renames
+
 def main(argv):
-    for dirname, dirnames, filenames in os.walk(argv[1]):
-        split_dir = dirname.split('/')
-        if bundle_token in split_dir[len(split_dir) - 1]:
-            bundle_namespace = dirname.split(bundle_token)[1]
-            base_dir = "/".join(split_dir[0: len(split_dir) - 1])
-            new_path = base_dir + "/" + bundle_namespace
-            os.execl("/bin/mv", dirname, new_path)
+    if len(argv) != 2:
+        print("Usage: %s <ipa directory>" % (os.path.basename(argv[0]),),
+              file=sys.stderr)
+        return 1
+
+    for path, new_path in bundle_renames(argv[1]):
+        if os.path.lexists(new_path):
+            print("error: %s: %s already exists" % (path, new_path),
+                  file=sys.stderr)
+            return 1
+        os.rename(path, new_path)
+    return 0
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -0,0 +1,69 @@
+#!/bin/bash
+# Runs acknowledgement_merger.py over the fragments in this directory, the way
+# the targets in BUILD.bazel chain it, and compares the finalized plists with
+# the checked in goldmasters.
+#
+# Usage: IntegrationTests/Acknowlegements/check_merger.sh [bazel-bin dir]
+#
+# With a bazel-bin directory, the plists Bazel built for this package are
+# compared too.
+
+set -e
+
+SCRIPTPATH="$( cd "$( dirname "${BASH_SOURCE[0]}"  )" && pwd  )"
+MERGER="$SCRIPTPATH/../../BazelExtensions/acknowledgement_merger.py"
+OUT=$(mktemp -d)
+trap "rm -rf $OUT" EXIT
+
+function merger() {
+    python3 "$MERGER" "$@"
+}
+
+function check() {
+    local name=$1
+    local output=$2
+    if diff "$SCRIPTPATH/$name.plist.goldmaster" "$output"; then
+        echo "PASS $name"
+    else
+        echo "FAILURE $name"
+        exit 1
+    fi
+}
+
+cd "$SCRIPTPATH"
+
+# Dep_acknowlegement
+merger --merge $OUT/Dep1_acknowledgement-acknowledgement.plist \
+    acknowledgement1.plist
+merger --merge $OUT/Dep2_acknowledgement-acknowledgement.plist \
+    acknowledgement2.plist
+merger --finalize $OUT/dep_acknowledgement.plist \
+    $OUT/Dep1_acknowledgement-acknowledgement.plist \
+    $OUT/Dep2_acknowledgement-acknowledgement.plist
+check dep_acknowledgement $OUT/dep_acknowledgement.plist
+
+# Shared_acknowlegement
+merger --merge $OUT/Dep3_acknowledgement-acknowledgement.plist \
+    acknowledgement3.plist
+merger --finalize $OUT/shared_acknowledgement.plist \
+    $OUT/Dep1_acknowledgement-acknowledgement.plist \
+    $OUT/Dep2_acknowledgement-acknowledgement.plist \
+    $OUT/Dep3_acknowledgement-acknowledgement.plist
+check shared_acknowledgement $OUT/shared_acknowledgement.plist
+
+# Manifest_acknowlegement
+merger --index $OUT/Dep3_manifest_acknowledgement-acknowledgement.plist \
+    acknowledgement3.plist $OUT/Dep1_acknowledgement-acknowledgement.plist
+merger --index $OUT/Dep2_manifest_acknowledgement-acknowledgement.plist \
+    acknowledgement2.plist \
+    $OUT/Dep3_manifest_acknowledgement-acknowledgement.plist
+merger --finalize $OUT/manifest_acknowledgement.plist \
+    $OUT/Dep2_manifest_acknowledgement-acknowledgement.plist
+check manifest_acknowledgement $OUT/manifest_acknowledgement.plist
+
+if [[ -n "$1" ]]; then
+    for name in dep_acknowledgement shared_acknowledgement \
+            manifest_acknowledgement; do
+        check $name "$1/IntegrationTests/Acknowlegements/$name.plist"
+    done
+fi
@@ -29,5 +29,13 @@ for f in $(find Examples/PodSpecs/*); do
 done
 
 
+# Test how update_pods.py prepares pods with local sources
+python3 tools/check_update_pods_local.py || exit 1
+
+# Test the downloads of update_pods.py against a local HTTP server
+python3 tools/check_update_pods_fetch.py || exit 1
+
 # Test that acknowledgement plist generation works
+IntegrationTests/Acknowlegements/check_merger.sh
 tools/bazel build  IntegrationTests/Acknowlegements/...
+IntegrationTests/Acknowlegements/check_merger.sh $(tools/bazel info bazel-bin)
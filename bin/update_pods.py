@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
 # update_pods.py Installs pods specified in Pods.WORKSPACE to $SRC_ROOT/Vendor/
 
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from subprocess import Popen, PIPE
+import asyncio
+import hashlib
+import json
 import os
 import sys
 import argparse
 import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
 SRC_ROOT = None
 
@@ -16,25 +27,111 @@ POD_PATHS = []
 def _getRepoToolPath():
     return os.path.dirname(os.path.realpath(__file__)) + "/RepoTools"
 
+class Profiler(object):
+    """ Records spans as Chrome trace events
+
+    The output loads in chrome://tracing or Perfetto. Each worker thread is
+    shown as its own track.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def add(self, name, category, start, end, args):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int((start - self.start) * 1e6),
+            "dur": int((end - start) * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+# Records timing when --profile is passed, set in main()
+PROFILER = None
+
+@contextmanager
+def _span(name, repository_ctx = None, category = "pod"):
+    """ Records the enclosed block as a span
+
+    Yields a dict of arguments to attach to the event.
+    """
+    args = {}
+    if repository_ctx and repository_ctx.target_name:
+        args["pod"] = repository_ctx.target_name
+    if not PROFILER:
+        yield args
+        return
+    start = time.monotonic()
+    try:
+        yield args
+    finally:
+        PROFILER.add(name, category, start, time.monotonic(), args)
+
+class PodUpdateError(Exception):
+    """ A command run on behalf of a pod failed """
+
+    def __init__(self, command, returncode, output, error):
+        self.command = command
+        self.returncode = returncode
+        self.output = output
+        self.error = error
+        Exception.__init__(self, "_exec failed %d %s %s" % (returncode,
+            " ".join(command), error.decode("utf-8", "replace").strip()))
+
 def _exec(repository_ctx, command, cwd = None):
     if repository_ctx.GetTrace():
         print("running: " + " ".join(command))
+    # Pods may be updated concurrently, so the working directory is passed to
+    # the child process rather than changing the process wide one.
     if cwd:
-        origWD = os.getcwd()
-        os.chdir(os.path.join(os.path.abspath(sys.path[0]), cwd))
+        cwd = os.path.join(os.path.abspath(sys.path[0]), cwd)
 
-    process = Popen(command, stdout=PIPE, stderr=PIPE)
-    result, error = process.communicate()
+    with _span(os.path.basename(command[0]), repository_ctx, "exec") as args:
+        args["command"] = " ".join(command)
+        process = Popen(command, stdout=PIPE, stderr=PIPE, cwd=cwd)
+        result, error = process.communicate()
+        args["exit_code"] = process.returncode
     if process.returncode != 0:
-        print("_exec failed %d %s %s" % (process.returncode, result, error))
-        sys.exit(1)
+        raise PodUpdateError(command, process.returncode, result, error)
 
     if repository_ctx.GetTrace():
         print(result)
-    if cwd:
-        os.chdir(origWD)
     return result
 
+# The number of subprocesses avoided by doing filesystem operations in process
+SAVED_PROCESS_COUNT = 0
+SAVED_PROCESS_LOCK = threading.Lock()
+
+def _native(repository_ctx, description):
+    """ Records a filesystem operation that used to be a subprocess """
+    global SAVED_PROCESS_COUNT
+    if repository_ctx.GetTrace():
+        print("native: " + description)
+    with SAVED_PROCESS_LOCK:
+        SAVED_PROCESS_COUNT += 1
+
+def _makedirs(repository_ctx, path):
+    _native(repository_ctx, "mkdir -p " + path)
+    os.makedirs(path, exist_ok=True)
+
+def _rmtree(repository_ctx, path):
+    _native(repository_ctx, "rm -rf " + path)
+    if os.path.islink(path) or os.path.isfile(path):
+        os.unlink(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
 def _cli_bool(b):
     if b:
         return "true"
@@ -47,6 +144,8 @@ class RepoToolsInvocationInfo(object):
     def __init__(self, repository_ctx):
         self.child_pods = []
         self.repository_ctx = repository_ctx
+        # The invocation of the parent of a child pod
+        self.parent = None
 
     def add_child_pod(self, pod):
         """ Adds the full context of the child pod """
@@ -57,29 +156,153 @@ class PodWorkspace(object):
     """ PodRepositoryContext """
 
     def __init__(self):
-        self.pods = []
+        # Pods by target name, in declaration order
+        self.pods_by_name = {}
+
+    @property
+    def pods(self):
+        return list(self.pods_by_name.values())
 
     def add(self, pod):
         """ Adds a pod to all known pods """
         # If there's already a pod defined, then don't add it again.
-        for existing_pod in self.pods:
-            if existing_pod.target_name == pod.target_name:
-                return
-        self.pods.append(pod)
-
-    def update(self):
+        if pod.target_name in self.pods_by_name:
+            return
+        self.pods_by_name[pod.target_name] = pod
+
+    def select(self, names):
+        """ Returns the target names of pods affected by updating `names`.
+
+        A child pod is initialized by its parent, so parents of affected child
+        pods are affected as well.
+        """
+        selected = set()
+        for name in names:
+            while name in self.pods_by_name and name not in selected:
+                selected.add(name)
+                name = _parent_pod_name(self.pods_by_name[name])
+        return selected
+
+    def update(self, jobs = 1, diff = None, only = None):
+        """ Updates all pods on `jobs` workers.
+
+        Pods that were added or modified in `diff` are started first, since
+        they are known to need an update. If `only` is set, just those target
+        names are updated.
+
+        Returns a dict of target name to the error for pods that failed.
+        """
         invocation_info_by_target = {}
         for pod in self.pods:
             invocation_info_by_target[pod.target_name] = RepoToolsInvocationInfo(repository_ctx=pod)
 
+        parent_by_target = {}
         for pod in self.pods:
-            if pod.url and pod.url.startswith("Vendor"):
-                parent_pod = pod.url.split("/")[1]
-                if parent_pod != pod.target_name:
-                    invocation_info_by_target[parent_pod].add_child_pod(pod)
-
-        for pod in self.pods:
-            _update_repo_impl(invocation_info_by_target[pod.target_name])
+            parent_pod = _parent_pod_name(pod)
+            if parent_pod:
+                invocation_info_by_target[parent_pod].add_child_pod(pod)
+                invocation_info_by_target[pod.target_name].parent = \
+                        invocation_info_by_target[parent_pod]
+                parent_by_target[pod.target_name] = parent_pod
+
+        pods = self.pods
+        if only is not None:
+            pods = [pod for pod in pods if pod.target_name in only]
+        if diff:
+            changed = set(diff.added + diff.modified)
+            pods.sort(key=lambda pod: pod.target_name not in changed)
+        invocation_infos = [invocation_info_by_target[pod.target_name]
+            for pod in pods]
+
+        if PREFETCHER:
+            PREFETCHER.start(invocation_infos)
+        try:
+            return _schedule_updates(invocation_infos, parent_by_target, jobs)
+        finally:
+            if PREFETCHER:
+                PREFETCHER.close()
+
+def _parent_pod_name(pod):
+    """ Returns the parent of a child pod, which has a url in Vendor/<parent> """
+    if pod.url and pod.url.startswith("Vendor"):
+        parent_pod = pod.url.split("/")[1]
+        if parent_pod != pod.target_name:
+            return parent_pod
+    return None
+
+class WorkspaceDiff(object):
+    """ The pods added, removed and modified in Pods.WORKSPACE since their
+    last update """
+
+    def __init__(self, added, removed, modified):
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+
+    def __str__(self):
+        return "%d added, %d removed, %d modified" % (len(self.added),
+                len(self.removed), len(self.modified))
+
+def _schedule_updates(invocation_infos, parent_by_target, jobs):
+    """ Runs `_update_repo_impl` for every pod on a pool of `jobs` workers.
+
+    Child pods are initialized from the source tree of their parent, so they
+    are only started once the parent finished updating. When a pod fails, its
+    children are skipped.
+    """
+    invocation_info_by_target = {}
+    children_by_target = {}
+    for invocation_info in invocation_infos:
+        target_name = invocation_info.repository_ctx.target_name
+        invocation_info_by_target[target_name] = invocation_info
+        if target_name in parent_by_target:
+            children_by_target.setdefault(parent_by_target[target_name],
+                    []).append(target_name)
+
+    failures = {}
+    finished = set()
+
+    def skip_children(target_name):
+        for child in children_by_target.get(target_name, []):
+            failures[child] = "skipped: parent pod " + target_name + " failed"
+            skip_children(child)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        pending = {}
+
+        def submit(target_name):
+            future = executor.submit(_update_repo_impl,
+                    invocation_info_by_target[target_name])
+            pending[future] = target_name
+
+        for invocation_info in invocation_infos:
+            target_name = invocation_info.repository_ctx.target_name
+            if target_name not in parent_by_target:
+                submit(target_name)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                target_name = pending.pop(future)
+                finished.add(target_name)
+                error = future.exception()
+                if error:
+                    failures[target_name] = error
+                    skip_children(target_name)
+                    continue
+                for child in children_by_target.get(target_name, []):
+                    submit(child)
+
+    # Pods that never became ready are part of a parent cycle
+    for target_name in invocation_info_by_target:
+        if target_name not in finished and target_name not in failures:
+            failures[target_name] = "skipped: cyclic parent pod url"
+    return failures
+
+def _print_failure_summary(failures):
+    print("Failed to update %d pod(s):" % len(failures))
+    for target_name in sorted(failures):
+        print("  " + target_name + ": " + str(failures[target_name]))
 
 class PodRepositoryContext(object):
     """ PodRepositoryContext """
@@ -119,10 +342,15 @@ class PodRepositoryContext(object):
     def GetPodRootDir(self):
         return self.src_root + "/Vendor/" + self.target_name
 
+    def GetDeclaration(self):
+        """ Returns the arguments of the pod's `new_pod_repository` """
+        declaration = self.__dict__.copy()
+        del declaration['src_root']
+        return declaration
+
     def GetIdentifier(self):
-        identifier_dict = self.__dict__.copy()
-        del identifier_dict['src_root']
-        return str(identifier_dict)
+        # Sort keys so the identifier is stable across runs
+        return json.dumps(self.GetDeclaration(), sort_keys=True)
 
     def GetTrace(self):
         global OVERRIDE_TRACE
@@ -130,19 +358,126 @@ class PodRepositoryContext(object):
             return True
         return self.trace
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
 def HashFile(path):
-    f = open(path, "rb")
-    f_hash = str(hash(f.read()))
-    f.close()
-    return str(f_hash)
+    """ Returns the SHA-256 hex digest of the contents of path """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class FileFingerprintCache(object):
+    """ Caches file digests keyed on path and (size, mtime, inode)
+
+    Tool binaries are the same for every pod, so they are hashed at most once
+    per run. When cache_path is set, the entries are persisted so that later
+    runs don't re-hash unchanged binaries.
+    """
+
+    def __init__(self, cache_path = None):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if cache_path:
+            # A missing or corrupt cache is rebuilt from scratch
+            self.entries = _read_json(cache_path) or {}
+
+    def digest(self, path):
+        stat = os.stat(path)
+        stat_key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry["stat"] == stat_key:
+                return entry["digest"]
+            digest = HashFile(path)
+            self.entries[path] = {"stat": stat_key, "digest": digest}
+            self.dirty = True
+            return digest
+
+    def save(self):
+        if not self.cache_path or not self.dirty:
+            return
+        _write_json(self.cache_path, self.entries)
+        self.dirty = False
+
+def _read_json(path):
+    """ Returns the JSON at path, or None if it is missing or corrupt """
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+def _write_json(path, value):
+    """ Atomically writes value as JSON to path """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "w") as f:
+        json.dump(value, f, sort_keys=True)
+    os.replace(tmp_path, path)
+
+# Fingerprints of tool binaries, reset in main()
+FINGERPRINTS = FileFingerprintCache()
 
 def GetVersion(invocation_info):
+    """ Returns a digest of everything that goes into initializing a pod.
+
+    Note: this must be deterministic across processes; the builtin `hash` is
+    salted per process and can't be used here.
+    """
     repository_ctx = invocation_info.repository_ctx
-    self_hash = HashFile(os.path.realpath(__file__))
-    repo_tool_hash = HashFile(_getRepoToolPath())
-    ctx_hash = str(hash(repository_ctx.GetIdentifier()))
-    child_pods = str(hash("".join([c.url for c in invocation_info.child_pods]))) if invocation_info.child_pods else ""
-    return self_hash + repo_tool_hash + ctx_hash + child_pods
+    version = hashlib.sha256()
+
+    def add(value):
+        version.update(value.encode("utf-8"))
+        version.update(b"\0")
+
+    add(FINGERPRINTS.digest(os.path.realpath(__file__)))
+    add(FINGERPRINTS.digest(_getRepoToolPath()))
+    add(repository_ctx.GetIdentifier())
+    for child_pod in invocation_info.child_pods:
+        add(child_pod.GetIdentifier())
+
+    podspec_digest = PODSPECS.resolve(repository_ctx)
+    if podspec_digest:
+        add(podspec_digest)
+
+    source_dir = _local_source_dir(repository_ctx)
+    if source_dir and not podspec_digest:
+        # Without a podspec_url, init reads the podspec from the pod's tree
+        for extension in [".podspec.json", ".podspec"]:
+            podspec_path = source_dir + "/" + repository_ctx.target_name + extension
+            if os.path.isfile(podspec_path):
+                add(HashFile(podspec_path))
+                break
+    if source_dir and repository_ctx.url:
+        # New top level files are only linked by an update
+        with os.scandir(source_dir) as entries:
+            add("/".join(sorted(entry.name for entry in entries
+                if not entry.name.startswith("."))))
+
+    # A child pod's podspec is read from its parent's tree
+    if invocation_info.parent:
+        add(GetVersion(invocation_info.parent))
+    return version.hexdigest()
+
+def _local_source_dir(repository_ctx):
+    """ Returns the directory of a local pod's sources, or None for a pod
+    fetched from a url, or vendored by its parent """
+    url = repository_ctx.url
+    if not url:
+        # The sources are put in Vendor/<name> directly
+        return repository_ctx.GetPodRootDir()
+    if _is_http_url(url) or url.startswith("Vendor"):
+        return None
+    if url.startswith("/"):
+        return url.rstrip("/")
+    return SRC_ROOT + "/" + url.rstrip("/")
 
 # Compiler Options
 
@@ -165,7 +500,276 @@ INHIBIT_WARNINGS_GLOBAL_COPTS = [
     "-Wno-everything",
 ]
 
+# The download cache shared with `RepoActions.fetch`
+POD_STORE_DIR = os.path.join(os.path.expanduser("~"), ".bazel_pod_store")
+
+def _pod_store_path(target_name, url):
+    """ Mirrors `cacheRoot(forPod:url:)` in RepoActions.swift """
+    return os.path.join(POD_STORE_DIR,
+            target_name + "-" + hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+# Seconds to wait to connect, or for data, before a download fails
+DOWNLOAD_TIMEOUT = 60
+
+def _download(url, path):
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+        with open(path, "wb") as f:
+            shutil.copyfileobj(response, f, HASH_CHUNK_SIZE)
+
+def _extract_command(archive_path, out_dir):
+    """ Returns the command to extract an archive, matching the archive types
+    that `RepoActions.fetch` supports """
+    file_name = os.path.basename(archive_path).lower()
+    if file_name.endswith("zip"):
+        return ["unzip", "-q", "-d", out_dir, archive_path]
+    for suffix in ["tar", "tar.gz", "tgz", "txz", "tar.xz"]:
+        if file_name.endswith(suffix):
+            return ["tar", "-xf", archive_path, "-C", out_dir]
+    return None
+
+def _download_archive(repository_ctx):
+    """ Downloads a remote pod's archive into a work directory in the pod
+    store, and returns its path """
+    target_name = repository_ctx.target_name
+    url = repository_ctx.url
+    file_name = os.path.basename(urllib.parse.urlparse(url).path)
+    os.makedirs(POD_STORE_DIR, exist_ok=True)
+    # Work in the store so the final rename is atomic; `RepoActions.fetch`
+    # treats any existing store directory as a complete download.
+    work_dir = tempfile.mkdtemp(prefix=".prefetch-" + target_name + "-",
+            dir=POD_STORE_DIR)
+    archive_path = os.path.join(work_dir, target_name + "-" + file_name)
+    try:
+        _download(url, archive_path)
+    except:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    return archive_path
+
+def _extract_archive(repository_ctx, archive_path):
+    """ Extracts an archive from `_download_archive` into the pod store, and
+    returns the pod's pod store path """
+    store_path = _pod_store_path(repository_ctx.target_name, repository_ctx.url)
+    work_dir = os.path.dirname(archive_path)
+    try:
+        out_dir = os.path.join(work_dir, "OUT")
+        os.makedirs(out_dir)
+        _exec(repository_ctx, _extract_command(archive_path, out_dir))
+        try:
+            os.rename(out_dir, store_path)
+        except OSError:
+            # Another process populated the store first
+            if not os.path.isdir(store_path):
+                raise
+        return store_path
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+class PodspecResolver(object):
+    """ Fetches and copies podspecs through a content addressed cache
+
+    The cache holds podspecs in objects/<sha256>, and the last response for
+    an HTTP podspec in urls/<sha256(url)>.json. HTTP podspecs are revalidated
+    with ETag and Last-Modified, so unchanged podspecs aren't downloaded
+    again. Each podspec is resolved at most once per run.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.digests = {}
+        self.lock = threading.Lock()
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest)
+
+    def _store(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def _fetch(self, url):
+        metadata_path = os.path.join(self.cache_dir, "urls",
+                hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+        metadata = _read_json(metadata_path)
+        if metadata and not os.path.isfile(self._object_path(metadata["digest"])):
+            metadata = None
+
+        request = urllib.request.Request(url)
+        if metadata and metadata.get("etag"):
+            request.add_header("If-None-Match", metadata["etag"])
+        if metadata and metadata.get("last_modified"):
+            request.add_header("If-Modified-Since", metadata["last_modified"])
+        try:
+            with urllib.request.urlopen(request,
+                    timeout=DOWNLOAD_TIMEOUT) as response:
+                data = response.read()
+                headers = response.headers
+        except urllib.error.HTTPError as error:
+            if error.code == 304 and metadata:
+                return metadata["digest"]
+            raise
+        except urllib.error.URLError as error:
+            if not metadata:
+                raise
+            print("warning: using cached podspec " + url + ": " + str(error))
+            return metadata["digest"]
+
+        digest = self._store(data)
+        _write_json(metadata_path, {
+            "digest": digest,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+        })
+        return digest
+
+    def resolve(self, repository_ctx):
+        """ Returns the digest of the pod's podspec, or None without one """
+        podspec_url = repository_ctx.podspec_url
+        if not podspec_url:
+            return None
+        with self.lock:
+            if podspec_url in self.digests:
+                return self.digests[podspec_url]
+
+        if _is_http_url(podspec_url):
+            digest = self._fetch(podspec_url)
+        else:
+            with open(_local_podspec_path(repository_ctx), "rb") as f:
+                digest = self._store(f.read())
+
+        with self.lock:
+            self.digests[podspec_url] = digest
+        return digest
+
+    def install(self, repository_ctx):
+        """ Copies the pod's podspec into the pod's directory """
+        digest = self.resolve(repository_ctx)
+        if not digest:
+            return
+        podspec_url = repository_ctx.podspec_url
+        if _is_http_url(podspec_url):
+            # Named like `curl -O`
+            file_name = os.path.basename(urllib.parse.urlparse(podspec_url).path)
+        else:
+            file_name = os.path.basename(podspec_url)
+        shutil.copyfile(self._object_path(digest),
+                repository_ctx.GetPodRootDir() + "/" + file_name)
+
+PODSPECS = PodspecResolver(os.path.join(POD_STORE_DIR, "podspecs"))
+
+def _profiled(name, fetch, args):
+    with _span(name, args[0], "prefetch"):
+        return fetch(*args)
+
+class Prefetcher(object):
+    """ Downloads remote pods and podspecs before they are initialized
+
+    Downloads run concurrently on an asyncio event loop, with at most
+    `max_downloads` connections at once. Podspecs are resolved first, since
+    they are part of the version of a pod. Archives are then downloaded in a
+    background thread, and each is extracted once its connection is
+    released, while pods that don't need a download are initialized.
+
+    A failed podspec prefetch is retried when the pod's version is computed.
+    A failed archive download fails the pod. Archives that can't be extracted
+    here are left to `RepoTool fetch`.
+    """
+
+    def __init__(self, max_downloads):
+        self.max_downloads = max_downloads
+        self.archives = {}
+        self.thread = None
+
+    def start(self, invocation_infos):
+        """ Starts prefetching for pods in invocation_infos that need an
+        update """
+        podspec_work = []
+        for invocation_info in invocation_infos:
+            repository_ctx = invocation_info.repository_ctx
+            podspec_url = repository_ctx.podspec_url
+            if podspec_url and _is_http_url(podspec_url):
+                podspec_work.append((Future(), "prefetch podspec",
+                    PODSPECS.resolve, (repository_ctx,), None))
+        if podspec_work:
+            asyncio.run(self._run(podspec_work))
+
+        archive_work = []
+        for invocation_info in invocation_infos:
+            repository_ctx = invocation_info.repository_ctx
+            target_name = repository_ctx.target_name
+            url = repository_ctx.url
+            if not url or not _is_http_url(url):
+                continue
+            if os.path.isdir(_pod_store_path(target_name, url)):
+                continue
+            file_name = os.path.basename(urllib.parse.urlparse(url).path)
+            if not _extract_command(file_name, ""):
+                continue
+            try:
+                if not _needs_update(invocation_info):
+                    continue
+            except Exception:
+                # Reported when the pod is updated
+                continue
+            self.archives[target_name] = Future()
+            archive_work.append((self.archives[target_name],
+                "prefetch archive", _download_archive, (repository_ctx,),
+                _extract_archive))
+        if not archive_work:
+            return
+        self.thread = threading.Thread(target=asyncio.run,
+                args=(self._run(archive_work),))
+        self.thread.daemon = True
+        self.thread.start()
+
+    async def _run(self, work):
+        semaphore = asyncio.Semaphore(self.max_downloads)
+        await asyncio.gather(*[self._fetch(semaphore, *item) for item in work])
+
+    async def _fetch(self, semaphore, future, name, fetch, args, finish):
+        """ Runs fetch holding a connection, then finish, if any, with its
+        result after the connection is released """
+        loop = asyncio.get_running_loop()
+        try:
+            async with semaphore:
+                result = await loop.run_in_executor(None, _profiled, name,
+                        fetch, args)
+            if finish:
+                result = await loop.run_in_executor(None, _profiled,
+                        name + " extract", finish, args + (result,))
+            future.set_result(result)
+        except Exception as error:
+            future.set_exception(error)
+
+    def wait_archive(self, repository_ctx):
+        """ Waits for the pod's archive, returning its pod store path
+
+        Raises the error of a failed download or extraction.
+        """
+        future = self.archives.get(repository_ctx.target_name)
+        if not future:
+            return None
+        return future.result()
+
+    def close(self):
+        if self.thread:
+            self.thread.join()
+
+# Prefetches downloads, set in main()
+PREFETCHER = None
+
 def _fetch_remote_repo(repository_ctx, repo_tool_bin, target_name, url):
+    if PREFETCHER:
+        # On success, `RepoTool fetch` is a pod store cache hit. A failed
+        # download fails the pod, rather than being tried again.
+        PREFETCHER.wait_archive(repository_ctx)
+
     fetch_cmd = [
         repo_tool_bin,
         target_name,
@@ -182,32 +786,83 @@ def _fetch_remote_repo(repository_ctx, repo_tool_bin, target_name, url):
 
 
 def _link_local_repo(repository_ctx, target_name, url):
-    cd = repository_ctx.GetPodRootDir()
-    from_dir = url + "/"
-    to_dir = cd + "/"
-    all_files = _exec(repository_ctx, ["ls", url]).split("\n")
-    # Link all of the files at the root directly
-    # ln -s url/* doesn't work.
-    for repo_file in all_files:
-        if len(repo_file) == 0:
-            continue
-        link_cmd = [
-            "ln",
-            "-sf",
-            from_dir + repo_file,
-            to_dir + repo_file
-        ]
-        _exec(repository_ctx, link_cmd)
+    """ Symlinks all of the files at the root of url into the pod directory
+
+    Links that already point at the right file are kept, and links to files
+    that no longer exist in url are removed. Other files in the pod directory,
+    i.e. generated BUILD files, are left alone.
+    """
+    to_dir = repository_ctx.GetPodRootDir()
+    from_dir = url.rstrip("/")
+
+    # Like `ls`, hidden files aren't linked
+    sources = {}
+    with os.scandir(from_dir) as entries:
+        for entry in entries:
+            if not entry.name.startswith("."):
+                sources[entry.name] = from_dir + "/" + entry.name
+
+    created = 0
+    kept = 0
+    removed = 0
+    with os.scandir(to_dir) as entries:
+        existing = [(entry.name, entry.is_symlink(), entry.is_dir(follow_symlinks=False))
+                for entry in entries]
+    for name, is_link, is_dir in existing:
+        path = to_dir + "/" + name
+        source = sources.get(name)
+        if is_link:
+            if source and os.readlink(path) == source:
+                kept += 1
+                del sources[name]
+                continue
+            os.unlink(path)
+            if not source:
+                removed += 1
+        elif source:
+            # A file is in the way of the link
+            if is_dir:
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+
+    for name, source in sources.items():
+        os.symlink(source, to_dir + "/" + name)
+        created += 1
+
+    if repository_ctx.GetTrace():
+        print("linked %s: %d created, %d kept, %d removed" % (target_name,
+            created, kept, removed))
+    return (created, kept, removed)
 
 def _needs_update(invocation_info):
     repository_ctx = invocation_info.repository_ctx
     target_name = repository_ctx.target_name
     pod_root_dir = repository_ctx.GetPodRootDir()
-    _exec(repository_ctx, ["/bin/bash", "-c", "mkdir -p " + pod_root_dir])
-    _exec(repository_ctx, ["/bin/bash", "-c", "touch .pod-version"], pod_root_dir)
-    cached_version = _exec(repository_ctx, ["/bin/bash", "-c", "cat .pod-version"], pod_root_dir).split(b'\n')[0]
+    _makedirs(repository_ctx, pod_root_dir)
+    version_path = pod_root_dir + "/.pod-version"
+    _native(repository_ctx, "touch " + version_path)
+    _native(repository_ctx, "cat " + version_path)
+    # Note: the stamp is created even if it is empty; this marks the directory
+    # as managed by update_pods for _cleanup_pods
+    with open(version_path, "a+") as version_file:
+        version_file.seek(0)
+        cached_version = version_file.read().split("\n")[0]
     return GetVersion(invocation_info) != cached_version
 
+# The directories `RepoTool init` generates in a pod's directory
+GENERATED_DIRS = ["pod_support", "pod_support_buildable"]
+
+def _stamped_url(repository_ctx):
+    """ Returns the url of the pod when it was last updated, from the second
+    line of its stamp """
+    try:
+        with open(repository_ctx.GetPodRootDir() + "/.pod-version") as version_file:
+            lines = version_file.read().split("\n")
+    except OSError:
+        return None
+    return lines[1] if len(lines) > 1 and lines[1] else None
+
 def _load_repo_if_needed(repository_ctx, repo_tool_bin_path):
     url = repository_ctx.url
     target_name = repository_ctx.target_name
@@ -217,20 +872,44 @@ def _load_repo_if_needed(repository_ctx, repo_tool_bin_path):
         return
 
 
-    if _is_http_url(url) or url.startswith("/"):
-        _exec(repository_ctx, ["rm", "-rf", repository_ctx.GetPodRootDir()])
-    _exec(repository_ctx, ["mkdir", "-p", repository_ctx.GetPodRootDir()])
+    # Note: local pods aren't removed, _link_local_repo reconciles the links.
+    # A linked pod whose stamp records another url, e.g. an archive, is, so
+    # none of the old files are left next to the links. Sources under
+    # Vendor/ are checked in, and never removed.
+    pod_root_dir = repository_ctx.GetPodRootDir()
+    if _is_http_url(url):
+        _rmtree(repository_ctx, pod_root_dir)
+    elif not url.startswith("Vendor"):
+        stamped_url = _stamped_url(repository_ctx)
+        if stamped_url and stamped_url != url:
+            _rmtree(repository_ctx, pod_root_dir)
+        else:
+            # init doesn't remove what it generated before, like links to
+            # headers that were removed since
+            for name in GENERATED_DIRS:
+                path = pod_root_dir + "/" + name
+                if os.path.isdir(path) and not os.path.islink(path):
+                    _rmtree(repository_ctx, path)
+    _makedirs(repository_ctx, pod_root_dir)
 
     if _is_http_url(url):
-        _fetch_remote_repo(repository_ctx, repo_tool_bin_path, target_name, url)
+        with _span("fetch", repository_ctx):
+            _fetch_remote_repo(repository_ctx, repo_tool_bin_path, target_name, url)
     elif url.startswith("/"):
-        _link_local_repo(repository_ctx, target_name, url)
+        with _span("link", repository_ctx):
+            _link_local_repo(repository_ctx, target_name, url)
     elif not url.startswith("Vendor"):
         # Assume that if a directory is already in vendor, then we should not
         # link
-        _link_local_repo(repository_ctx, target_name, SRC_ROOT + "/" + url)
+        with _span("link", repository_ctx):
+            _link_local_repo(repository_ctx, target_name, SRC_ROOT + "/" + url)
 
 def _update_repo_impl(invocation_info):
+    repository_ctx = invocation_info.repository_ctx
+    with _span("update " + repository_ctx.target_name, repository_ctx):
+        _update_repo(invocation_info)
+
+def _update_repo(invocation_info):
     repository_ctx = invocation_info.repository_ctx
     if repository_ctx.GetTrace():
         print("__RUN with repository_ctx", repository_ctx.__dict__)
@@ -238,8 +917,9 @@ def _update_repo_impl(invocation_info):
     global POD_PATHS
     POD_PATHS.append(repository_ctx.GetPodRootDir())
 
-    if not _needs_update(invocation_info):
-        return
+    with _span("version check", repository_ctx):
+        if not _needs_update(invocation_info):
+            return
 
     # Note: the pod is not cleaned out if the sourcecode is loaded from the
     # current directory
@@ -319,24 +999,13 @@ def _update_repo_impl(invocation_info):
         else:
             substitutions[name] = " ".join(entry)
 
+    # The podspec is placed in the pod's directory before the script runs
+    with _span("podspec fetch", repository_ctx):
+        PODSPECS.install(repository_ctx)
+
     # Build up the script
     script = ""
 
-    if repository_ctx.podspec_url:
-        # For now, we curl the podspec url before the script runs
-        if _is_http_url(repository_ctx.podspec_url):
-            script += "curl -O " + repository_ctx.podspec_url
-            script += "\n"
-        else:
-            # Dump a podspec into this directory
-            if repository_ctx.podspec_url.startswith("/"):
-                script += "ditto " + repository_ctx.podspec_url + " ."
-                script += "\n"
-            else:
-                workspace_dir = repository_ctx.src_root
-                script += "ditto " + workspace_dir + "/" + repository_ctx.podspec_url + " ."
-                script += "\n"
-
     if repository_ctx.install_script_tpl:
         for sub in substitutions:
             install_script_tpl = install_script_tpl.replace(sub, substitutions[sub])
@@ -344,12 +1013,15 @@ def _update_repo_impl(invocation_info):
     else:
         script += substitutions[INIT_REPO_PLACEHOLDER]
 
-    _exec(repository_ctx,
-            ["/bin/bash", "-c", script],
-            repository_ctx.GetPodRootDir())
+    with _span("RepoTool init", repository_ctx):
+        _exec(repository_ctx,
+                ["/bin/bash", "-c", script],
+                repository_ctx.GetPodRootDir())
 
-    with open(repository_ctx.GetPodRootDir() + "/.pod-version", "w") as version_file:
-        version_file.write(GetVersion(invocation_info))
+    with _span("stamp write", repository_ctx):
+        with open(repository_ctx.GetPodRootDir() + "/.pod-version", "w") as version_file:
+            version_file.write(GetVersion(invocation_info) + "\n" +
+                    (url or ""))
 
 def new_pod_repository(name,
             url = None,
@@ -454,12 +1126,16 @@ def new_pod_repository(name,
             src_root = SRC_ROOT)
     WORKSPACE.add(repository_ctx)
 
-def _cleanup_pods():
-    """Cleanup removed Pods from Vendor"""
+def _cleanup_pods(only = None):
+    """Cleanup removed Pods from Vendor
+
+    If `only` is set, just those pods are considered for removal.
+    """
     pods_dir = SRC_ROOT + "/Vendor"
     known_pods = set(POD_PATHS)
 
-    for dirname in os.listdir(pods_dir):
+    dirnames = os.listdir(pods_dir) if only is None else only
+    for dirname in dirnames:
         full_path = pods_dir + "/" + dirname
         if full_path in known_pods:
             continue
@@ -467,6 +1143,15 @@ def _cleanup_pods():
             continue
         shutil.rmtree(full_path)
 
+def _local_podspec_path(repository_ctx):
+    """ Returns the path of a podspec that is on disk, if any """
+    podspec_url = repository_ctx.podspec_url
+    if not podspec_url or _is_http_url(podspec_url):
+        return None
+    if podspec_url.startswith("/"):
+        return podspec_url
+    return repository_ctx.src_root + "/" + podspec_url
+
 def _is_http_url(url):
     return url.startswith("http://") or url.startswith("https://")
 
@@ -495,17 +1180,215 @@ def _vendorize_bazel_extensions_if_needed():
         os.makedirs(rules_pods_root)
         shutil.copytree(bazel_extension_dir, vendor_path)
 
-def load(path):
+def _workspace_cache_path():
+    return SRC_ROOT + "/Vendor/.pods-workspace-cache.json"
+
+def _tools_digest():
+    """ Returns a digest of the tools that go into the version of every pod """
+    return hashlib.sha256((FINGERPRINTS.digest(os.path.realpath(__file__)) +
+        FINGERPRINTS.digest(_getRepoToolPath())).encode("utf-8")).hexdigest()
+
+class WorkspaceCache(object):
+    """ Caches the pods declared in Pods.WORKSPACE, and the declarations of
+    the pods as of their last update
+
+    The evaluated declarations are keyed by the digest of this script, and of
+    Pods.WORKSPACE and every file it loads: while they are unchanged,
+    Pods.WORKSPACE isn't evaluated again. The declarations of the last update
+    are only replaced once an update succeeds, so a failed pod is still in
+    the next diff.
     """
-    Loads a Pods.WORKSPACE file
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        # A missing or corrupt cache is rebuilt from scratch
+        self.entry = _read_json(cache_path) or {}
+        self.script = None
+        self.files = {}
+
+    def _files_unchanged(self, files):
+        for path, digest in files.items():
+            try:
+                with open(SRC_ROOT + "/" + path, "rb") as f:
+                    if hashlib.sha256(f.read()).hexdigest() != digest:
+                        return False
+            except OSError:
+                return False
+        return True
+
+    def load(self, path):
+        """ Adds the pods of the Pods.WORKSPACE at path to WORKSPACE """
+        global LOADED_FILES
+        self.script = FINGERPRINTS.digest(os.path.realpath(__file__))
+        files = self.entry.get("files")
+        if self.entry.get("script") == self.script and files and \
+                self._files_unchanged(files):
+            for declaration in self.entry["pods"]:
+                WORKSPACE.add(PodRepositoryContext(src_root=SRC_ROOT,
+                    **declaration))
+            self.files = files
+            return
+
+        LOADED_FILES = {}
+        try:
+            load(path)
+        finally:
+            self.files = LOADED_FILES
+            LOADED_FILES = None
+
+    def diff(self, tools):
+        """ Returns a WorkspaceDiff of the pods since their last update
+
+        Returns None when every pod must be checked: if no update is
+        recorded, or if the tools changed since.
+        """
+        if "updated" not in self.entry or self.entry.get("tools") != tools:
+            return None
+        return _diff_declarations(self.entry["updated"],
+                [pod.GetDeclaration() for pod in WORKSPACE.pods])
+
+    def save(self, tools, only = None):
+        """ Records that the pods in `only`, or all pods, were updated """
+        current = [pod.GetDeclaration() for pod in WORKSPACE.pods]
+        updated = current
+        if only is not None:
+            # The other pods are as of their previous update
+            updated_by_name = dict((d["target_name"], d)
+                    for d in self.entry.get("updated", [])
+                    if d["target_name"] not in only)
+            for declaration in current:
+                if declaration["target_name"] in only:
+                    updated_by_name[declaration["target_name"]] = declaration
+            updated = list(updated_by_name.values())
+            tools = self.entry.get("tools")
+        self.entry = {
+            "script": self.script,
+            "files": self.files,
+            "pods": current,
+            "tools": tools,
+            "updated": updated,
+        }
+        _write_json(self.cache_path, self.entry)
+
+def _pods_to_check(diff):
+    """ Returns the target names of pods that may need an update, given the
+    WorkspaceDiff since their last update
+
+    A remote pod whose declaration didn't change is up to date if it has a
+    stamp. Local sources and podspecs may have changed on disk, and child
+    pods are initialized from their parent's tree.
     """
-    global SRC_ROOT
-    # Eval the Pods.WORKSPACE
-    # Here, we simply collect pods
-    with open(SRC_ROOT +  "/" + path, "r") as workspace:
-        workspace_str = workspace.read()
+    names = set(diff.added + diff.removed + diff.modified)
+    for pod in WORKSPACE.pods:
+        podspec_url = pod.podspec_url
+        if _local_source_dir(pod) or (podspec_url and
+                not _is_http_url(podspec_url)):
+            names.add(pod.target_name)
+        elif not os.path.isfile(pod.GetPodRootDir() + "/.pod-version"):
+            names.add(pod.target_name)
+    for pod in WORKSPACE.pods:
+        if _parent_pod_name(pod) in names:
+            names.add(pod.target_name)
+    return names
+
+def _diff_declarations(previous, current):
+    previous_by_name = dict((d["target_name"], d) for d in previous)
+    current_by_name = dict((d["target_name"], d) for d in current)
+    added = [name for name in current_by_name if name not in previous_by_name]
+    removed = [name for name in previous_by_name if name not in current_by_name]
+    modified = [name for name in current_by_name
+            if name in previous_by_name
+            and current_by_name[name] != previous_by_name[name]]
+    return WorkspaceDiff(added, removed, modified)
+
+def _evaluate_workspace(workspace_str, workspace):
+    """ Evals a Pods.WORKSPACE, adding the pods it declares to workspace """
+    global WORKSPACE
+    current_workspace = WORKSPACE
+    WORKSPACE = workspace
+    try:
+        # Here, we simply collect pods
         d = dict(locals(), **globals())
         exec(workspace_str, d, d)
+    finally:
+        WORKSPACE = current_workspace
+
+def _is_under(path, directory):
+    return path == directory or path.startswith(directory + "/")
+
+def _pods_changed_since(rev, path):
+    """ Returns the target names of pods changed since the git revision rev
+
+    A pod changed if its declaration in the Pods.WORKSPACE at path changed,
+    or if files changed in its local source directory or podspec.
+    """
+    git_ctx = PodRepositoryContext(None, None, None, None, None, None, None)
+    # Fails outside of a git repository, or if rev isn't a commit
+    _exec(git_ctx, ["git", "rev-parse", "--verify", rev + "^{commit}"],
+            SRC_ROOT)
+    previous_workspace = PodWorkspace()
+    global LOAD_REVISION
+    LOAD_REVISION = rev
+    try:
+        previous_str = _exec(git_ctx, ["git", "show", rev + ":./" + path],
+                SRC_ROOT).decode("utf-8")
+        _evaluate_workspace(previous_str, previous_workspace)
+    except PodUpdateError:
+        # The workspace, or a file it loads, didn't exist at rev
+        pass
+    finally:
+        LOAD_REVISION = None
+
+    diff = _diff_declarations(
+            [pod.GetDeclaration() for pod in previous_workspace.pods],
+            [pod.GetDeclaration() for pod in WORKSPACE.pods])
+    changed = set(diff.added + diff.removed + diff.modified)
+
+    changed_files = _exec(git_ctx, ["git", "diff", "--name-only", "--relative",
+        rev], SRC_ROOT).decode("utf-8").splitlines()
+    changed_files += _exec(git_ctx, ["git", "ls-files", "--others",
+        "--exclude-standard"], SRC_ROOT).decode("utf-8").splitlines()
+    for pod in WORKSPACE.pods:
+        local_paths = []
+        for url in [pod.url, pod.podspec_url]:
+            # Vendor/ is populated by this script, so it isn't a source
+            if not url or _is_http_url(url) or url.startswith("Vendor"):
+                continue
+            if url.startswith("/"):
+                if not _is_under(url, SRC_ROOT):
+                    continue
+                url = os.path.relpath(url, SRC_ROOT)
+            local_paths.append(url.rstrip("/"))
+        for changed_file in changed_files:
+            if any(_is_under(changed_file, p) for p in local_paths):
+                changed.add(pod.target_name)
+                break
+    return changed
+
+# The paths and digests of the files read by load(), while Pods.WORKSPACE is
+# evaluated for the workspace cache
+LOADED_FILES = None
+
+# The git revision to load files at, while the Pods.WORKSPACE of a previous
+# revision is evaluated
+LOAD_REVISION = None
+
+def load(path):
+    """
+    Loads a file of pod declarations relative to SRC_ROOT, like
+    Pods.WORKSPACE. Pods.WORKSPACE may split its pods into other files, and
+    load them.
+    """
+    if LOAD_REVISION:
+        git_ctx = PodRepositoryContext(None, None, None, None, None, None, None)
+        data = _exec(git_ctx, ["git", "show", LOAD_REVISION + ":./" + path],
+                SRC_ROOT)
+    else:
+        with open(SRC_ROOT + "/" + path, "rb") as f:
+            data = f.read()
+    if LOADED_FILES is not None:
+        LOADED_FILES[path] = hashlib.sha256(data).hexdigest()
+    _evaluate_workspace(data.decode("utf-8"), WORKSPACE)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -520,6 +1403,46 @@ def main():
         dest="trace",
         action="store_true",
         help="Dump debug info")
+
+    parser.add_argument("--jobs",
+        type=int,
+        default=1,
+        help="""
+    The number of pods to update in parallel. Child pods are always updated
+    after their parent.
+    """)
+
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument("--only",
+        nargs="+",
+        metavar="POD",
+        help="""
+    Only update these pods, and the parents of child pods. Other vendored pods
+    are left alone.
+    """)
+
+    selection.add_argument("--changed-since",
+        dest="changed_since",
+        metavar="GIT_REV",
+        help="""
+    Only update pods whose declaration, local source or podspec changed since
+    this git revision.
+    """)
+
+    parser.add_argument("--max-downloads",
+        dest="max_downloads",
+        type=int,
+        default=8,
+        help="""
+    The number of remote pods and podspecs to download concurrently before
+    they are initialized. 0 disables prefetching.
+    """)
+
+    parser.add_argument("--profile",
+        metavar="OUT_JSON",
+        help="""
+    Write per pod timings and all subprocesses as Chrome trace event JSON
+    """)
     args = parser.parse_args()
 
     global SRC_ROOT
@@ -530,15 +1453,70 @@ def main():
     if not SRC_ROOT:
         SRC_ROOT = os.getcwd()
 
+    global PROFILER
+    if args.profile:
+        PROFILER = Profiler()
+
+    global PREFETCHER
+    if args.max_downloads > 0:
+        PREFETCHER = Prefetcher(args.max_downloads)
+
+    global FINGERPRINTS
+    FINGERPRINTS = FileFingerprintCache(SRC_ROOT + "/Vendor/.tool-fingerprints.json")
+
     print("Updating pods in " + SRC_ROOT)
     global OVERRIDE_TRACE
     OVERRIDE_TRACE = args.trace
 
-    _build_repo_tools()
+    try:
+        _build_repo_tools()
+    except PodUpdateError as error:
+        print(error)
+        sys.exit(1)
 
-    load("Pods.WORKSPACE")
-    WORKSPACE.update()
-    _cleanup_pods()
+    workspace_cache = WorkspaceCache(_workspace_cache_path())
+    workspace_cache.load("Pods.WORKSPACE")
+    tools = _tools_digest()
+    diff = workspace_cache.diff(tools)
+    if OVERRIDE_TRACE:
+        print("Pods.WORKSPACE: " + (str(diff) if diff is not None else
+                "checking all pods"))
+
+    affected = None
+    if args.only:
+        unknown = sorted(set(args.only) - set(WORKSPACE.pods_by_name))
+        if unknown:
+            parser.error("--only: not in Pods.WORKSPACE: " + " ".join(unknown))
+        affected = set(args.only)
+    elif args.changed_since:
+        try:
+            affected = _pods_changed_since(args.changed_since, "Pods.WORKSPACE")
+        except PodUpdateError as error:
+            # Not a git repository, or not a revision
+            parser.error("--changed-since %s: %s" % (args.changed_since,
+                error.error.decode("utf-8", "replace").strip()))
+    elif diff is not None:
+        affected = _pods_to_check(diff)
+    only = WORKSPACE.select(affected) if affected is not None else None
+    if only is not None:
+        print("Updating %d of %d pods" % (len(only), len(WORKSPACE.pods)))
+
+    failures = WORKSPACE.update(jobs=args.jobs, diff=diff, only=only)
+    FINGERPRINTS.save()
+    if PROFILER:
+        PROFILER.write(args.profile)
+    if OVERRIDE_TRACE:
+        print("Saved %d subprocesses with in-process filesystem operations" %
+                SAVED_PROCESS_COUNT)
+    if failures:
+        # Don't cleanup, since failed pods aren't known to be up to date
+        _print_failure_summary(failures)
+        sys.exit(1)
+    workspace_cache.save(tools, only)
+    # Pods removed from Pods.WORKSPACE are only cleaned up if they were
+    # selected
+    _cleanup_pods(affected)
     _vendorize_bazel_extensions_if_needed()
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# bench_acknowledgement_merger.py Benchmarks for
+# BazelExtensions/acknowledgement_merger.py
+#
+# Usage: tools/bench_acknowledgement_merger.py replay [--actions FILE]
+#            [--pods N] [--deps N] [--mode merge|index]
+#
+# replay runs a recorded list of acknowledgement_merger actions, one JSON
+# object per line, { "arguments": [...], "inputs": [...] }, in order: once
+# with a process per action and once through a single persistent worker, and
+# reports the latency per action. Without --actions, the actions of a
+# synthetic pod graph are recorded and replayed: every pod acknowledges the
+# previous --deps pods, and the last action finalizes the plist.
+
+import argparse
+import os
+import plistlib
+import tempfile
+
+import bench_worker
+
+MERGER = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), "BazelExtensions", "acknowledgement_merger.py")
+
+k_licenses = [
+    "MIT License\n\nPermission is hereby granted, free of charge, to any "
+    "person obtaining a copy of this software.\n" * 20,
+    "Apache License\nVersion 2.0, January 2004\n" * 80,
+    "BSD License\n\nRedistribution and use in source and binary forms.\n" * 30,
+]
+
+def record_pod_graph_actions(opts, work_dir):
+    actions = []
+    outputs = []
+    for i in range(opts.pods):
+        name = "Pod%d" % i
+        value = os.path.join(work_dir, name + ".plist")
+        with open(value, "wb") as f:
+            plistlib.dump({
+                "Title": name,
+                "Type": "PSGroupSpecifier",
+                "License": "MIT",
+                "FooterText": k_licenses[i % len(k_licenses)],
+            }, f, fmt=plistlib.FMT_XML)
+        out = os.path.join(work_dir, name + "-acknowledgement.plist")
+        inputs = [value] + outputs[-opts.deps:]
+        actions.append({
+            "arguments": ["--" + opts.mode, out] + inputs,
+            "inputs": inputs,
+        })
+        outputs.append(out)
+
+    inputs = outputs[-opts.deps:]
+    actions.append({
+        "arguments": ["--finalize",
+                      os.path.join(work_dir, "Acknowledgements.plist")] + inputs,
+        "inputs": inputs,
+    })
+    return actions
+
+def bench_replay(opts, work_dir):
+    if opts.actions:
+        actions = bench_worker.read_actions(opts.actions)
+    else:
+        actions = record_pod_graph_actions(opts, work_dir)
+    bench_worker.replay(MERGER, actions)
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    replay_parser = subparsers.add_parser("replay",
+        help="time acknowledgement_merger actions with and without a worker")
+    replay_parser.add_argument("--actions",
+        help="recorded actions, one JSON object per line")
+    replay_parser.add_argument("--pods", type=int, default=200)
+    replay_parser.add_argument("--deps", type=int, default=4)
+    replay_parser.add_argument("--mode", choices=["merge", "index"],
+                               default="merge")
+    replay_parser.set_defaults(func=bench_replay)
+
+    opts = parser.parse_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        opts.func(opts, work_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# bench_headermap.py Benchmarks for BazelExtensions/headermap_tool.py
+#
+# Usage: tools/bench_headermap.py write [--entries N]
+#        tools/bench_headermap.py deep [--depth N] [--width N] [--headers N]
+#        tools/bench_headermap.py replay [--actions FILE] [--depth N] ...
+#
+# replay runs a recorded list of headermap_builder actions, one JSON object
+# per line, { "arguments": [...], "inputs": [...] }, in order: once with a
+# process per action and once through a single persistent worker. Without
+# --actions, the actions of the deep graph are recorded and replayed.
+
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+
+EXTENSIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), "BazelExtensions")
+sys.path.insert(0, EXTENSIONS_DIR)
+
+import bench_worker
+import headermap_builder
+import headermap_tool
+
+def make_mappings(num_entries):
+    """ Mappings shaped like a transitive pod headermap """
+    mappings = {}
+    for i in range(num_entries // 2):
+        pod = "Pod%d" % (i % 200)
+        header = "Header%d.h" % i
+        path = "bazel-out/ios-fastbuild/genfiles/external/%s/Sources/%s" % (
+            pod, header)
+        mappings[pod + "/" + header] = path
+        mappings[header] = path
+    return mappings
+
+def legacy_write(input_path, output_path):
+    """ The headermap writer before string interning and batched packing """
+    with open(input_path, "r") as f:
+        mappings = json.load(f)["mappings"]
+
+    def hmap_hash(str):
+        return sum((ord(c.lower()) * 13 for c in str), 0)
+
+    num_buckets = headermap_tool.next_power_of_two(len(mappings) * 3)
+    table = [(0, 0, 0) for i in range(num_buckets)]
+    max_value_len = 0
+    strtable = "\0"
+    for key,value in mappings.items():
+        max_value_len = max(max_value_len, len(value))
+        key_idx = len(strtable)
+        strtable += key + '\0'
+        prefix = os.path.dirname(value) + '/'
+        suffix = os.path.basename(value)
+        prefix_idx = len(strtable)
+        strtable += prefix + '\0'
+        suffix_idx = len(strtable)
+        strtable += suffix + '\0'
+
+        hash = hmap_hash(key)
+        for i in range(num_buckets):
+            idx = (hash + i) % num_buckets
+            if table[idx][0] == 0:
+                table[idx] = (key_idx, prefix_idx, suffix_idx)
+                break
+
+    header_fmt = '<HHIIII'
+    bucket_fmt = '<III'
+    strtable_offset = 4 + struct.calcsize(header_fmt) + \
+        num_buckets * struct.calcsize(bucket_fmt)
+    with open(output_path, 'wb') as f:
+        f.write(headermap_tool.k_header_magic_LE.encode())
+        f.write(struct.pack(header_fmt, 1, 0, strtable_offset, len(mappings),
+                            num_buckets, max_value_len))
+        for bucket in table:
+            f.write(struct.pack(bucket_fmt, *bucket))
+        f.write(strtable.encode())
+
+def timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+def bench_write(opts, work_dir):
+    input_path = os.path.join(work_dir, "mappings.json")
+    with open(input_path, "w") as f:
+        json.dump({"mappings": make_mappings(opts.entries)}, f)
+
+    legacy = timed(legacy_write, input_path,
+                   os.path.join(work_dir, "legacy.hmap"))
+    current = timed(headermap_tool.action_write, "write",
+                    [input_path, os.path.join(work_dir, "current.hmap")])
+    print("write %d entries" % opts.entries)
+    print("  legacy:  %8.3fs %10d bytes" % (
+        legacy, os.path.getsize(os.path.join(work_dir, "legacy.hmap"))))
+    print("  current: %8.3fs %10d bytes" % (
+        current, os.path.getsize(os.path.join(work_dir, "current.hmap"))))
+    print("  speedup: %8.1fx" % (legacy / current))
+
+def total_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+def make_deep_graph(opts, work_dir):
+    """ A layered graph where every target depends on all targets of the
+    level below it, like the headermap rules of a deep pod graph """
+    levels = []
+    for depth in range(opts.depth):
+        level = []
+        for i in range(opts.width):
+            name = "Pod%d_%d" % (depth, i)
+            json_path = os.path.join(work_dir, name + ".json")
+            mappings = {}
+            for h in range(opts.headers):
+                header = "%s_Header%d.h" % (name, h)
+                path = "bazel-out/genfiles/external/%s/%s" % (name, header)
+                mappings[name + "/" + header] = path
+                mappings[header] = path
+            with open(json_path, "w") as f:
+                json.dump({"mappings": mappings}, f)
+            level.append((name, json_path))
+        levels.append(level)
+    return levels
+
+def bench_deep(opts, work_dir):
+    """ Times both modes over the deep graph, and counts the bytes of the
+    inputs read and the outputs written by the actions of each
+
+    Every target still writes its full headermap in layered mode, since its
+    library compiles against it, so bytes written don't go down. The merge
+    reads each transitive mapping once, instead of once per path to it
+    through the merged headermaps of deps.
+    """
+    levels = make_deep_graph(opts, work_dir)
+
+    def run(build):
+        inputs = []
+        outputs = []
+        start = time.perf_counter()
+        deps = []
+        for level in levels:
+            deps = [build(name, json_path, deps, inputs, outputs)
+                    for name,json_path in level]
+        return time.perf_counter() - start, inputs, outputs
+
+    def legacy(name, json_path, deps, inputs, outputs):
+        out = os.path.join(work_dir, name + ".hmap")
+        headermap_builder.build_headermap(out, json_path, deps)
+        inputs.extend([json_path] + deps)
+        outputs.append(out)
+        return out
+
+    def layered(name, json_path, deps, inputs, outputs):
+        layer = os.path.join(work_dir, name + ".hmaplayer")
+        manifest = os.path.join(work_dir, name + ".hmapmanifest")
+        out = os.path.join(work_dir, name + "_layered.hmap")
+        headermap_builder.build_layer(layer, manifest, json_path, deps)
+        headermap_builder.build_from_manifest(out, manifest)
+        inputs.extend([json_path] + deps + [manifest] +
+                      headermap_builder.read_manifest(manifest))
+        outputs.extend([layer, manifest, out])
+        return manifest
+
+    legacy_time, legacy_inputs, legacy_outputs = run(legacy)
+    layered_time, layered_inputs, layered_outputs = run(layered)
+
+    top = levels[-1][0][0]
+    expected = sorted(headermap_tool.HeaderMap.frompath(
+        os.path.join(work_dir, top + ".hmap")).mappings)
+    actual = sorted(headermap_tool.HeaderMap.frompath(
+        os.path.join(work_dir, top + "_layered.hmap")).mappings)
+    if expected != actual:
+        raise SystemExit("error: layered headermap differs")
+
+    print("deep graph: depth %d, width %d, %d headers per target" % (
+        opts.depth, opts.width, opts.headers))
+    print("  legacy:  %8.3fs %10d bytes read %10d bytes written" % (
+        legacy_time, total_size(legacy_inputs), total_size(legacy_outputs)))
+    print("  layered: %8.3fs %10d bytes read %10d bytes written" % (
+        layered_time, total_size(layered_inputs),
+        total_size(layered_outputs)))
+    print("  speedup: %8.1fx" % (legacy_time / layered_time))
+
+def record_deep_actions(opts, work_dir):
+    """ The actions of the classic headermap rule over the deep graph """
+    actions = []
+    deps = []
+    for level in make_deep_graph(opts, work_dir):
+        outputs = []
+        for name,json_path in level:
+            out = os.path.join(work_dir, name + ".hmap")
+            actions.append({
+                "arguments": [out, json_path] + deps,
+                "inputs": [json_path] + deps,
+            })
+            outputs.append(out)
+        deps = outputs
+    return actions
+
+def bench_replay(opts, work_dir):
+    if opts.actions:
+        actions = bench_worker.read_actions(opts.actions)
+    else:
+        actions = record_deep_actions(opts, work_dir)
+    bench_worker.replay(os.path.join(EXTENSIONS_DIR, "headermap_builder.py"),
+                        actions)
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    write_parser = subparsers.add_parser("write",
+        help="time writing one headermap")
+    write_parser.add_argument("--entries", type=int, default=100000)
+    write_parser.set_defaults(func=bench_write)
+
+    deep_parser = subparsers.add_parser("deep",
+        help="time building the headermaps of a deep target graph")
+    deep_parser.add_argument("--depth", type=int, default=20)
+    deep_parser.add_argument("--width", type=int, default=4)
+    deep_parser.add_argument("--headers", type=int, default=50)
+    deep_parser.set_defaults(func=bench_deep)
+
+    replay_parser = subparsers.add_parser("replay",
+        help="time headermap_builder actions with and without a worker")
+    replay_parser.add_argument("--actions",
+        help="recorded actions, one JSON object per line")
+    replay_parser.add_argument("--depth", type=int, default=20)
+    replay_parser.add_argument("--width", type=int, default=4)
+    replay_parser.add_argument("--headers", type=int, default=50)
+    replay_parser.set_defaults(func=bench_replay)
+
+    opts = parser.parse_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        opts.func(opts, work_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# bench_worker.py Helpers for the benchmarks of the helper programs Bazel
+# runs as persistent workers, see BazelExtensions/persistent_worker.py
+#
+# An action is a JSON object, { "arguments": [...], "inputs": [...] }.
+# Recorded actions are stored one per line.
+
+import hashlib
+import json
+import subprocess
+import sys
+import time
+
+def read_actions(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def print_latencies(name, latencies):
+    latencies = sorted(latencies)
+    print("  %-19s mean %7.2fms, p50 %7.2fms, max %7.2fms, total %7.3fs" % (
+        name + ":", 1000 * sum(latencies) / len(latencies),
+        1000 * latencies[len(latencies) // 2], 1000 * latencies[-1],
+        sum(latencies)))
+
+def replay(program, actions):
+    """ Runs actions in order, once with a process per action and once through
+    a single persistent worker, and prints the latency per action """
+    process_latencies = []
+    for action in actions:
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, program] + action["arguments"])
+        process_latencies.append(time.perf_counter() - start)
+
+    worker = subprocess.Popen([sys.executable, program, "--persistent_worker"],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              universal_newlines=True)
+    worker_latencies = []
+    for request_id,action in enumerate(actions):
+        start = time.perf_counter()
+        # Digests are computed when the action runs, like Bazel would
+        request = {
+            "arguments": action["arguments"],
+            "inputs": [{"path": path, "digest": file_digest(path)}
+                       for path in action.get("inputs", [])],
+            "requestId": request_id,
+        }
+        worker.stdin.write(json.dumps(request) + "\n")
+        worker.stdin.flush()
+        response = json.loads(worker.stdout.readline())
+        if response["exitCode"] != 0:
+            raise SystemExit("error: action %d failed: %s" % (
+                request_id, response["output"]))
+        worker_latencies.append(time.perf_counter() - start)
+    worker.stdin.close()
+    worker.wait()
+
+    print("replay %d actions" % len(actions))
+    print_latencies("process per action", process_latencies)
+    print_latencies("persistent worker", worker_latencies)
+    print("  speedup: %8.1fx" % (sum(process_latencies) / sum(worker_latencies)))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# check_update_pods_fetch.py Checks the downloads of bin/update_pods.py
+# against a local HTTP server
+#
+# Usage: tools/check_update_pods_fetch.py
+#
+# Covers podspec revalidation with ETag, where an unchanged podspec is a 304
+# and a changed one is downloaded again, and the failures of podspecs and
+# prefetched archives: an HTTP error, and a server that stops responding,
+# which must time out rather than hang.
+
+import http.server
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), "bin"))
+
+import update_pods
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # path -> (etag, body)
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append((self.path,
+                                 self.headers.get("If-None-Match")))
+        if self.path.startswith("/stalled/"):
+            time.sleep(update_pods.DOWNLOAD_TIMEOUT * 3)
+            return
+        entry = Handler.files.get(self.path)
+        if not entry:
+            self.send_error(404)
+            return
+        etag, body = entry
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def check(name, condition):
+    print(("PASS " if condition else "FAILURE ") + name)
+    if not condition:
+        sys.exit(1)
+
+def pod(name, url=None, podspec_url=None):
+    return update_pods.PodRepositoryContext(name, url, podspec_url, "", [], "")
+
+def raises(f, *args):
+    try:
+        f(*args)
+    except Exception as error:
+        return error
+    return None
+
+def main():
+    update_pods.OVERRIDE_TRACE = False
+    update_pods.DOWNLOAD_TIMEOUT = 0.5
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:%d" % server.server_address[1]
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as f:
+        f.writestr("Pod/Pod.h", "")
+    Handler.files["/Pod.zip"] = ("\"a\"", archive.getvalue())
+    Handler.files["/Pod.podspec.json"] = ("\"1\"", b"{\"version\": 1}")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        update_pods.POD_STORE_DIR = work_dir
+        podspecs = update_pods.PodspecResolver(os.path.join(work_dir, "specs"))
+
+        # A new resolver per run, like a new run of update_pods.py
+        url = base + "/Pod.podspec.json"
+        first = podspecs.resolve(pod("Pod", podspec_url=url))
+        podspecs = update_pods.PodspecResolver(podspecs.cache_dir)
+        second = podspecs.resolve(pod("Pod", podspec_url=url))
+        check("podspec revalidated with its ETag",
+              Handler.requests[-1] == ("/Pod.podspec.json", "\"1\"") and
+              first == second)
+
+        Handler.files["/Pod.podspec.json"] = ("\"2\"", b"{\"version\": 2}")
+        podspecs = update_pods.PodspecResolver(podspecs.cache_dir)
+        third = podspecs.resolve(pod("Pod", podspec_url=url))
+        check("changed podspec downloaded again", third != first)
+
+        error = raises(podspecs.resolve,
+                       pod("Missing", podspec_url=base + "/Missing.podspec"))
+        check("missing podspec fails", error is not None)
+
+        start = time.time()
+        error = raises(podspecs.resolve, pod("Stalled",
+                       podspec_url=base + "/stalled/Pod.podspec"))
+        check("stalled podspec times out",
+              error is not None and time.time() - start < 2)
+
+        # Every pod needs an update, without a RepoTool to stamp versions
+        update_pods._needs_update = lambda invocation_info: True
+        pods = [pod("Pod", base + "/Pod.zip"),
+                pod("Missing", base + "/Missing.zip"),
+                pod("Stalled", base + "/stalled/Pod.zip")]
+        prefetcher = update_pods.Prefetcher(2)
+        start = time.time()
+        prefetcher.start([update_pods.RepoToolsInvocationInfo(p)
+                          for p in pods])
+        store_path = prefetcher.wait_archive(pods[0])
+        check("archive prefetched into the pod store",
+              os.path.isfile(os.path.join(store_path, "Pod", "Pod.h")))
+        check("failed archive download fails the pod",
+              raises(prefetcher.wait_archive, pods[1]) is not None)
+        check("stalled archive download times out",
+              raises(prefetcher.wait_archive, pods[2]) is not None)
+        prefetcher.close()
+        check("prefetcher closes", time.time() - start < 3)
+
+if __name__ == "__main__":
+    main()
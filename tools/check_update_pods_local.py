@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# check_update_pods_local.py Checks how bin/update_pods.py prepares the
+# directories of pods with local sources, on a copy of Examples/ChildPodspec
+#
+# Usage: tools/check_update_pods_local.py
+#
+# Covers pods with sources checked in under Vendor/<name>, which must survive
+# an update with a stamp from before stamps recorded urls, and linked pods,
+# which are cleared when their url changed, and otherwise keep their links
+# while the pod_support tree generated by the last init is removed. Also
+# covers --changed-since on a workspace that loads its pods from another file.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bin"))
+
+import update_pods
+
+def check(name, condition):
+    print(("PASS " if condition else "FAILURE ") + name)
+    if not condition:
+        sys.exit(1)
+
+def pod(name, url):
+    return update_pods.PodRepositoryContext(name, url, None, "", [], "",
+                                            src_root=update_pods.SRC_ROOT)
+
+def stamp(repository_ctx, contents):
+    """ Writes a stamp, like _needs_update does before an update """
+    os.makedirs(repository_ctx.GetPodRootDir(), exist_ok=True)
+    with open(repository_ctx.GetPodRootDir() + "/.pod-version", "w") as f:
+        f.write(contents)
+
+def check_changed_since(work_dir):
+    src_root = os.path.join(work_dir, "Loading")
+    os.makedirs(src_root)
+    update_pods.SRC_ROOT = src_root
+
+    def git(*args):
+        subprocess.check_call(["git", "-c", "user.name=check",
+                               "-c", "user.email=check@example.com"] +
+                              list(args), cwd=src_root,
+                              stdout=subprocess.DEVNULL)
+
+    def write_deps(url):
+        with open(os.path.join(src_root, "deps.py"), "w") as f:
+            f.write("new_pod_repository(name = \"Remote\", url = \"%s\")\n"
+                    % url)
+            f.write("new_pod_repository(name = \"Same\", "
+                    "url = \"https://example.com/Same.zip\")\n")
+
+    with open(os.path.join(src_root, "Pods.WORKSPACE"), "w") as f:
+        f.write("load(\"deps.py\")\n")
+    write_deps("https://example.com/Remote-1.zip")
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "1")
+    write_deps("https://example.com/Remote-2.zip")
+    git("commit", "-q", "-a", "-m", "2")
+
+    update_pods.WORKSPACE = update_pods.PodWorkspace()
+    update_pods.load("Pods.WORKSPACE")
+    changed = update_pods._pods_changed_since("HEAD~1", "Pods.WORKSPACE")
+    check("--changed-since loads files at the revision",
+          changed == set(["Remote"]))
+
+def main():
+    update_pods.OVERRIDE_TRACE = False
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        src_root = os.path.join(work_dir, "ChildPodspec")
+        shutil.copytree(os.path.join(ROOT, "Examples", "ChildPodspec"),
+                        src_root, symlinks=True)
+        update_pods.SRC_ROOT = src_root
+        vendor = os.path.join(src_root, "Vendor")
+
+        # A fresh clone: .pod-version is ignored by git, so it starts empty
+        for name, url in [("Parent", "Vendor/Parent"),
+                          ("Child", "Vendor/Parent/Child")]:
+            repository_ctx = pod(name, url)
+            stamp(repository_ctx, "")
+            update_pods._load_repo_if_needed(repository_ctx, "RepoTools")
+        parent = os.path.join(vendor, "Parent")
+        check("checked in Vendor/ sources are kept",
+              os.path.isfile(os.path.join(parent, "Parent.podspec")) and
+              os.path.isdir(os.path.join(parent, "Sources")) and
+              os.path.isfile(os.path.join(parent, "Child", "Child.podspec")))
+
+        # A linked pod, with the output of an earlier init
+        local = os.path.join(src_root, "Local")
+        os.makedirs(local)
+        for name in ["Local.podspec", "Local.h"]:
+            open(os.path.join(local, name), "w").close()
+        repository_ctx = pod("Local", "Local")
+        stamp(repository_ctx, "")
+        update_pods._load_repo_if_needed(repository_ctx, "RepoTools")
+        pod_dir = repository_ctx.GetPodRootDir()
+        headers = os.path.join(pod_dir, "pod_support", "Headers", "Public")
+        os.makedirs(headers)
+        os.symlink("../../../Removed.h", os.path.join(headers, "Removed.h"))
+        open(os.path.join(pod_dir, "BUILD.bazel"), "w").close()
+
+        stamp(repository_ctx, "version\nLocal")
+        update_pods._load_repo_if_needed(repository_ctx, "RepoTools")
+        check("generated pod_support is cleared before init",
+              not os.path.exists(os.path.join(pod_dir, "pod_support")))
+        check("links of a linked pod are kept",
+              os.path.islink(os.path.join(pod_dir, "Local.h")) and
+              os.path.isfile(os.path.join(pod_dir, "BUILD.bazel")))
+
+        stamp(repository_ctx, "version\nhttps://example.com/Local.zip")
+        open(os.path.join(pod_dir, "Extracted.h"), "w").close()
+        update_pods._load_repo_if_needed(repository_ctx, "RepoTools")
+        check("a pod whose url changed is cleared",
+              not os.path.exists(os.path.join(pod_dir, "Extracted.h")) and
+              os.path.islink(os.path.join(pod_dir, "Local.h")))
+
+        check_changed_since(work_dir)
+
+if __name__ == "__main__":
+    main()